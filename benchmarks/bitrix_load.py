@@ -0,0 +1,160 @@
+"""Загрузка лидов через LeadFetcher без Bitrix24: локальный сервер отвечает на batch.json синтетическими лидами
+так же, как портал - страницами по 50 записей с result_total, не больше 50 команд в batch и ошибкой
+QUERY_LIMIT_EXCEEDED, если запросы приходят чаще лимита портала.
+
+    python -m benchmarks.bitrix_load --users 200 --leads 120 --rate 2 --concurrency 2
+"""
+import argparse
+import asyncio
+import datetime
+import time
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+from bitrix_leads import BATCH_SIZE, PAGE_SIZE, LeadFetcher, format_bx_datetime
+from broadcast import TokenBucket
+
+PATH = "/rest/1/token"
+# Часовой пояс портала: даты лидов он отдает в своем времени со смещением, даты фильтра без смещения
+# считает своими
+PORTAL_TZ = datetime.timezone(datetime.timedelta(hours=3))
+
+
+def make_leads(users, per_user, days=30):
+    """per_user лидов каждого из пользователей 1..users, созданных равномерно за последние days дней"""
+    now = datetime.datetime.now().replace(microsecond=0)
+    leads = []
+    for bx_id in range(1, users + 1):
+        for number in range(per_user):
+            created = portal_datetime(now - datetime.timedelta(days=days) * (number + 1) / per_user)
+            leads.append({"ID": str(len(leads) + 1), "CREATED_BY_ID": str(bx_id), "DATE_CREATE": created,
+                          "DATE_MODIFY": created, "STATUS_ID": "CONVERTED" if number % 4 == 0 else "NEW",
+                          "DATE_CLOSED": ""})
+    return leads
+
+
+def portal_datetime(value):
+    """Локальное время -> дата в том виде, в каком ее отдает портал"""
+    return value.astimezone(PORTAL_TZ).isoformat(timespec="seconds")
+
+
+def _parse(value):
+    value = datetime.datetime.fromisoformat(value)
+    return value if value.tzinfo else value.replace(tzinfo=PORTAL_TZ)
+
+
+def _matches(lead, conditions):
+    for key, value in conditions.items():
+        if key == "CREATED_BY_ID" and lead["CREATED_BY_ID"] != value:
+            return False
+        if key == ">=DATE_CREATE" and _parse(lead["DATE_CREATE"]) < _parse(value):
+            return False
+        if key == ">DATE_MODIFY" and _parse(lead["DATE_MODIFY"]) <= _parse(value):
+            return False
+    return True
+
+
+class MockBitrix:
+    """Сервер batch.json для crm.lead.list. rate - лимит портала в запросах в секунду (None - без лимита),
+    reject_first - сколько первых запросов отклонить с QUERY_LIMIT_EXCEEDED независимо от лимита"""
+
+    def __init__(self, leads, rate=None, burst=None, reject_first=0):
+        self.leads = leads
+        # Фильтр по CREATED_BY_ID есть почти в каждой команде, без индекса сервер сам становится узким местом
+        self.by_user = {}
+        for lead in leads:
+            self.by_user.setdefault(lead["CREATED_BY_ID"], []).append(lead)
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.reject_first = reject_first
+        self.requests = 0
+        self.rejected = 0
+        self.commands = 0
+        self.max_commands = 0
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(PATH + "/batch.json", self.handle)
+        return app
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.requests <= self.reject_first or self.bucket and self.bucket.delay():
+            self.rejected += 1
+            return web.json_response({"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"},
+                                     status=503)
+        cmd = (await request.json())["cmd"]
+        if len(cmd) > BATCH_SIZE:
+            return web.json_response({"error": "INVALID_REQUEST",
+                                      "error_description": f"Max batch length exceeded ({BATCH_SIZE})"}, status=400)
+        self.commands += len(cmd)
+        self.max_commands = max(self.max_commands, len(cmd))
+        result = {"result": {}, "result_error": {}, "result_total": {}, "result_next": {}}
+        for key, command in cmd.items():
+            method, _, query = command.partition("?")
+            if method != "crm.lead.list":
+                result["result_error"][key] = {"error": "ERROR_METHOD_NOT_FOUND", "error_description": method}
+                continue
+            params = dict(parse_qsl(query))
+            conditions = {name[len("filter["):-1]: value for name, value in params.items()
+                          if name.startswith("filter[")}
+            fields = [value for name, value in params.items() if name.startswith("select[")]
+            candidates = self.by_user.get(conditions["CREATED_BY_ID"], []) if "CREATED_BY_ID" in conditions \
+                else self.leads
+            found = [lead for lead in candidates if _matches(lead, conditions)]
+            start = int(params.get("start", 0))
+            result["result"][key] = [{field: lead[field] for field in fields}
+                                     for lead in found[start:start + PAGE_SIZE]]
+            result["result_total"][key] = len(found)
+            if start + PAGE_SIZE < len(found):
+                result["result_next"][key] = start + PAGE_SIZE
+        return web.json_response({"result": result, "time": {}})
+
+
+async def serve(server):
+    """Запускает server на свободном порту, возвращает (runner, адрес вебхука для LeadFetcher)"""
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}{PATH}/"
+
+
+async def run(leads, filters, rate, concurrency, portal_rate=None, reject_first=0, retry_delay=2):
+    """Загружает лиды по filters с mock-сервера, возвращает (лиды, {"seconds", "requests", "rejected",
+    "commands", "max_commands"})"""
+    server = MockBitrix(leads, portal_rate, reject_first=reject_first)
+    runner, url = await serve(server)
+    fetcher = LeadFetcher(url, rate, concurrency, retry_delay=retry_delay)
+    started = time.monotonic()
+    try:
+        fetched = await fetcher.fetch(filters)
+    finally:
+        await fetcher.close()
+        await runner.cleanup()
+    return fetched, {"seconds": time.monotonic() - started, "requests": server.requests,
+                     "rejected": server.rejected, "commands": server.commands, "max_commands": server.max_commands}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Загрузка лидов LeadFetcher с локального mock-сервера Bitrix24")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--leads", type=int, default=120, help="лидов на пользователя")
+    parser.add_argument("--days", type=int, default=30, help="за сколько дней загружать лиды")
+    parser.add_argument("--rate", type=float, default=2, help="запросов в секунду от LeadFetcher")
+    parser.add_argument("--concurrency", type=int, default=2, help="одновременных batch от LeadFetcher")
+    parser.add_argument("--portal-rate", type=float, default=2, help="лимит портала, 0 - без лимита")
+    parser.add_argument("--retry-delay", type=float, default=2)
+    args = parser.parse_args()
+
+    since = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=args.days - 1), datetime.time())
+    filters = [{">=DATE_CREATE": format_bx_datetime(since), "CREATED_BY_ID": str(bx_id)}
+               for bx_id in range(1, args.users + 1)]
+    fetched, stats = asyncio.run(run(make_leads(args.users, args.leads), filters, args.rate, args.concurrency,
+                                     args.portal_rate or None, retry_delay=args.retry_delay))
+    print(f"{len(fetched)} leads of {args.users} users in {stats['seconds']:.2f}s: {stats['requests']} batch requests "
+          f"({stats['rejected']} QUERY_LIMIT_EXCEEDED), {stats['commands']} commands, "
+          f"up to {stats['max_commands']} per batch")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Нагрузка на общую SQLite-БД из нескольких процессов: писатели сохраняют ответы по одному (commit на каждый
+ответ - худший случай) с заданной суммарной частотой, читатели параллельно строят статистику.
+Считает достигнутую частоту записи и ошибки "database is locked".
+
+    python -m benchmarks.db_stress --rate 200 --writers 4 --readers 2 --duration 10
+"""
+import argparse
+import datetime
+import multiprocessing
+import os
+import tempfile
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from database import database_handler
+
+QUESTIONS = 10
+USERS_PER_WRITER = 100000
+
+
+def prepare(path, writers):
+    db = database_handler.Handler(path)
+    for _ in range(QUESTIONS):
+        db.create_question(database_handler.Question(text="Q", for_all=True, answer_options=["Да", "Нет"],
+                                                     optional=False, send_datetime=datetime.datetime.now()))
+    for tg_user_id in range(1, writers * 10 + 1):
+        db.create_user(tg_user_id, f"u{tg_user_id}", f"User{tg_user_id}")
+    db.engine.dispose()
+
+
+def writer(path, index, rate, duration, start, results):
+    db = database_handler.Handler(path)
+    written = locked = 0
+    start.wait()
+    started = time.monotonic()
+    while True:
+        # Следующая запись по расписанию от начала, чтобы задержки отдельных commit не снижали частоту
+        due = started + written / rate
+        if due - started >= duration:
+            break
+        time.sleep(max(due - time.monotonic(), 0))
+        tg_user_id = index * USERS_PER_WRITER + written // QUESTIONS + 1
+        try:
+            db.create_answer(tg_user_id, written % QUESTIONS + 1, option_id=written % 2)
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            locked += 1
+        written += 1
+    results.put(("writer", written, locked, time.monotonic() - started))
+
+
+def reader(path, duration, start, results):
+    db = database_handler.Handler(path)
+    db.tally_ttl = 0
+    reads = locked = 0
+    start.wait()
+    started = time.monotonic()
+    while time.monotonic() - started < duration:
+        question_id = reads % QUESTIONS + 1
+        try:
+            db.get_tallies(question_id)
+            db.get_answers_with_users(question_id, limit=100)
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            locked += 1
+        reads += 1
+    results.put(("reader", reads, locked, time.monotonic() - started))
+
+
+def run(path, rate, writers, readers, duration):
+    """{"rate": ответов в секунду, "written": ответов, "reads": чтений, "locked": ошибок блокировки}"""
+    prepare(path, writers)
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    # Отсчет начинается, когда все процессы запущены: иначе первые писатели делят процессор с импортом остальных
+    start = context.Barrier(writers + readers)
+    processes = [context.Process(target=writer, args=(path, index, rate / writers, duration, start, results))
+                 for index in range(writers)]
+    processes += [context.Process(target=reader, args=(path, duration, start, results)) for _ in range(readers)]
+    for process in processes:
+        process.start()
+    rows = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    written = sum(count for kind, count, _, _ in rows if kind == "writer")
+    elapsed = max(elapsed for kind, _, _, elapsed in rows if kind == "writer")
+    return {"rate": written / elapsed, "written": written, "reads": sum(count for kind, count, _, _ in rows
+                                                                        if kind == "reader"),
+            "locked": sum(locked for _, _, locked, _ in rows)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузка на SQLite-БД бота из нескольких процессов")
+    parser.add_argument("--rate", type=float, default=200, help="ответов в секунду от всех писателей")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10, help="секунд")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        stats = run(os.path.join(directory, "db.db"), args.rate, args.writers, args.readers, args.duration)
+    print(f"{stats['written']} answers in {args.duration:.0f}s from {args.writers} processes: "
+          f"{stats['rate']:.1f} answers/s, {stats['reads']} stats reads from {args.readers} processes, "
+          f"{stats['locked']} 'database is locked' errors")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Выгрузка ответов на большой БД: заполняет БД синтетическими пользователями, ролями и ответами (или берет
+готовую), выгружает все ответы через export.export_answers и печатает время и пиковую память процесса.
+
+    python -m benchmarks.export_load --answers 1000000 --format csv
+    python -m benchmarks.export_load --db /tmp/big.db --format parquet
+"""
+import argparse
+import datetime
+import os
+import resource
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import export
+from database import database_handler
+
+QUESTIONS = 20
+ROLES = ("staff", "sales", "support")
+# Сколько строк вставляется одним executemany при заполнении
+SEED_CHUNK = 100000
+
+
+def seed(path, answers, users):
+    """Создает БД с QUESTIONS опросами (половина - со свободным ответом), users пользователями и answers ответами.
+    Строки вставляются напрямую: через ORM миллион ответов заполнялся бы десятки минут"""
+    db = database_handler.Handler(path)
+    for number in range(QUESTIONS):
+        options = ["Да", "Нет", "Не знаю"] if number % 2 == 0 else []
+        db.create_question(database_handler.Question(text=f"Опрос {number + 1}", for_all=True,
+                                                     answer_options=options, optional=False,
+                                                     send_datetime=datetime.datetime.now()))
+    for role in ROLES:
+        db.create_role(role)
+    db.engine.dispose()
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT INTO users (tg_user_id, username, user_str, admin) VALUES (?, ?, ?, 0)",
+                         [(tg_user_id, f"u{tg_user_id}", f"Пользователь {tg_user_id}")
+                          for tg_user_id in range(1, users + 1)])
+        conn.executemany("INSERT INTO user_roles (tg_user_id, role_name) VALUES (?, ?)",
+                         [(tg_user_id, ROLES[tg_user_id % len(ROLES)]) for tg_user_id in range(1, users + 1, 2)])
+    # Пары (пользователь, опрос) уникальны: ответ number - от пользователя number % users на опрос number // users + 1
+    for start in range(0, answers, SEED_CHUNK):
+        with conn:
+            conn.executemany("INSERT INTO answers (user_id, question_id, option_id, text) VALUES (?, ?, ?, ?)",
+                             [_answer(number, users) for number in range(start, min(start + SEED_CHUNK, answers))])
+    conn.close()
+
+
+def _answer(number, users):
+    question_id = number // users % QUESTIONS + 1
+    if question_id % 2 == 1:
+        return number % users + 1, question_id, number % 3, None
+    return number % users + 1, question_id, None, f"Свободный ответ {number}, \"с кавычками\""
+
+
+def run(path, fmt="csv", output=None):
+    """{"rows": выгружено ответов, "seconds": время выгрузки, "size": размер файла в байтах}"""
+    output = output or path + "." + fmt
+    started = time.monotonic()
+    rows = export.export_answers(database_handler.Handler(path), output, fmt=fmt)
+    seconds = time.monotonic() - started
+    size = os.path.getsize(output)
+    os.remove(output)
+    return {"rows": rows, "seconds": seconds, "size": size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время и память выгрузки ответов на синтетической БД")
+    parser.add_argument("--answers", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=50000, help="answers не больше users * 20")
+    parser.add_argument("-f", "--format", choices=export.FORMATS, default="csv")
+    parser.add_argument("--db", help="путь к БД, которая остается после замера; если файла нет, он заполняется, "
+                                     "иначе используется как есть. По умолчанию - временная БД")
+    args = parser.parse_args()
+    if args.answers > args.users * QUESTIONS:
+        parser.error(f"--answers должно быть не больше --users * {QUESTIONS}")
+
+    directory = None if args.db else tempfile.mkdtemp()
+    path = args.db or os.path.join(directory, "db.db")
+    if not os.path.exists(path):
+        started = time.monotonic()
+        seed(path, args.answers, args.users)
+        print(f"Seeded {args.answers} answers in {time.monotonic() - started:.1f}s")
+    try:
+        stats = run(path, args.format)
+    finally:
+        if directory:
+            shutil.rmtree(directory)
+    # ru_maxrss - пик за весь процесс, включая заполнение, поэтому для чистого замера используйте --db
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    print(f"Exported {stats['rows']} answers to {args.format} in {stats['seconds']:.1f}s, "
+          f"{stats['size'] / 1024 / 1024:.0f} MB, max RSS {max_rss} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Чтение пользователей и опросов: NamedTuple-записи Handler против прежнего способа - глубокой копии
+ORM-объектов (copy.deepcopy(session.query(...).all())), которую раньше возвращали get_users и get_questions.
+
+    python -m benchmarks.records --users 5000 --questions 500 --repeat 5
+"""
+import argparse
+import copy
+import datetime
+import os
+import tempfile
+import time
+
+from database import database_handler
+from database.database_handler import Question, User
+
+ROLES = ("staff", "sales", "support")
+
+
+def seed(db, users, questions):
+    for role in ROLES:
+        db.create_role(role)
+    with db.session_scope() as session:
+        for tg_user_id in range(1, users + 1):
+            user = User(tg_user_id, f"u{tg_user_id}", f"User{tg_user_id}")
+            user.roles.append(ROLES[tg_user_id % len(ROLES)])
+            session.add(user)
+        for number in range(questions):
+            session.add(Question(text=f"Q{number}", for_all=False, roles_for=[ROLES[number % len(ROLES)]],
+                                 users_for=[number % users + 1], answer_options=["Да", "Нет"], optional=False,
+                                 send_datetime=datetime.datetime.now()))
+
+
+def deepcopy_all(db, model):
+    with db.session_scope() as session:
+        return copy.deepcopy(session.query(model).all())
+
+
+def best_time(call, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(path, users, questions, repeat):
+    """{"users_deepcopy", "users_records", "questions_deepcopy", "questions_records"}: лучшее время в секундах"""
+    db = database_handler.Handler(path)
+    seed(db, users, questions)
+    return {"users_deepcopy": best_time(lambda: deepcopy_all(db, User), repeat),
+            "users_records": best_time(db.get_users, repeat),
+            "questions_deepcopy": best_time(lambda: deepcopy_all(db, Question), repeat),
+            "questions_records": best_time(db.get_questions, repeat)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Записи NamedTuple против deepcopy ORM-объектов")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--questions", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5, help="замеров, берется лучший")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        stats = run(os.path.join(directory, "db.db"), args.users, args.questions, args.repeat)
+    for name, count in (("users", args.users), ("questions", args.questions)):
+        deepcopy_time, records_time = stats[name + "_deepcopy"], stats[name + "_records"]
+        print(f"{count} {name}: deepcopy {deepcopy_time * 1000:.0f} ms, records {records_time * 1000:.0f} ms "
+              f"({deepcopy_time / records_time:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Нагрузочная проверка webhook-сервера без Telegram: отправляет синтетические обновления POST-запросами
+на локальный WebhookServer, за которым стоит заглушка бота, и считает задержку от запроса до ответа.
+
+    python -m benchmarks.webhook_load --updates 5000 --chats 500 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+
+from webhook import WebhookServer
+
+PATH = "/bot"
+SECRET = "secret"
+
+
+class StubBot:
+    """Вместо обработчиков бота: "отвечает" на обновление через handle_time секунд и запоминает время ответа"""
+
+    def __init__(self, handle_time):
+        self.handle_time = handle_time
+        self.replied = {}
+
+    async def process_new_updates(self, updates):
+        for update in updates:
+            await asyncio.sleep(self.handle_time)
+            self.replied[update.update_id] = time.monotonic()
+
+
+def make_update(update_id, chat_id):
+    return json.dumps({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "Да",
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "User"}}})
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0.0
+
+
+async def run(updates, chats, concurrency, workers, queue_size, handle_time, port):
+    bot = StubBot(handle_time)
+    server = WebhookServer(bot, PATH, SECRET, workers, queue_size)
+    runner = web.AppRunner(server.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    port = runner.addresses[0][1]
+    workers_task = asyncio.create_task(server.run_workers())
+
+    posted = {}
+    statuses = {}
+    ids = iter(range(1, updates + 1))
+    url = f"http://127.0.0.1:{port}{PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+    async def client(session):
+        for update_id in ids:
+            body = make_update(update_id, update_id % chats + 1)
+            posted[update_id] = time.monotonic()
+            async with session.post(url, data=body, headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    started = time.monotonic()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+    accepted = statuses.get(200, 0)
+    while len(bot.replied) < accepted:
+        await asyncio.sleep(0.01)
+    elapsed = time.monotonic() - started
+
+    workers_task.cancel()
+    await runner.cleanup()
+
+    latencies = [bot.replied[update_id] - posted[update_id] for update_id in bot.replied]
+    stats = server.stats()
+    print(f"{updates} updates from {chats} chats, {concurrency} connections, {workers} queues: "
+          f"{elapsed:.2f}s ({accepted / elapsed:.0f} updates/s), HTTP statuses {statuses}")
+    print(f"update-to-reply latency: p50 {percentile(latencies, 0.5) * 1000:.1f}ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms, max {max(latencies, default=0) * 1000:.1f}ms")
+    print(f"server stats: processed {stats['processed']}, rejected {stats['rejected']}, "
+          f"avg queue latency {stats['avg_latency'] * 1000:.1f}ms")
+    return stats, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочная проверка webhook-сервера синтетическими обновлениями")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных HTTP-соединений")
+    parser.add_argument("--workers", type=int, default=8, help="очередей сервера")
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--handle-time", type=float, default=0.001, help="секунд на обработку одного обновления")
+    parser.add_argument("--port", type=int, default=0, help="0 - любой свободный")
+    args = parser.parse_args()
+    asyncio.run(run(args.updates, args.chats, args.concurrency, args.workers, args.queue_size, args.handle_time,
+                    args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import asyncio
+import datetime
+import time
+from urllib.parse import urlencode
+
+import aiohttp
+from bitrix24.exceptions import BitrixError
+
+from broadcast import TokenBucket
+
+# Поля лида, которые нужны для статистики и локального хранилища
+LEAD_FIELDS = ("ID", "CREATED_BY_ID", "DATE_CREATE", "DATE_MODIFY", "STATUS_ID", "DATE_CLOSED")
+# Лиды, измененные незадолго до синхронизации, загружаются повторно: часы сервера и портала могут расходиться
+SYNC_MARGIN = datetime.timedelta(minutes=5)
+# Ограничения Bitrix24: не больше 50 команд в batch и 50 записей на страницу списка
+BATCH_SIZE = 50
+PAGE_SIZE = 50
+
+
+def _flatten(params, prefix=""):
+    for key, value in params.items():
+        name = f"{prefix}[{key}]" if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif isinstance(value, (list, tuple)):
+            yield from _flatten(dict(enumerate(value)), name)
+        else:
+            yield name, value
+
+
+def build_command(method, params):
+    return f"{method}?{urlencode(list(_flatten(params)))}"
+
+
+def format_bx_datetime(value):
+    """Локальное время сервера для фильтра Bitrix24: со смещением, иначе портал сочтет его своим временем"""
+    return value.astimezone().isoformat(timespec="seconds")
+
+
+class LeadFetcher:
+    """Загружает лиды через batch-запросы Bitrix24 с общим ограничением частоты запросов"""
+
+    def __init__(self, webhook_url, rate=2, concurrency=2, fields=LEAD_FIELDS, retry_delay=2):
+        self.url = webhook_url.rstrip("/") + "/batch.json"
+        self.bucket = TokenBucket(rate)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.fields = fields
+        # Пауза перед повтором batch, отклоненного с QUERY_LIMIT_EXCEEDED
+        self.retry_delay = retry_delay
+        self.session = None
+
+    async def _session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def batch(self, commands):
+        """commands: {ключ: (метод, параметры)} -> ответ batch (result, result_total, result_next...)"""
+        cmd = {key: build_command(method, params) for key, (method, params) in commands.items()}
+        session = await self._session()
+        while True:
+            async with self.semaphore:
+                await self.bucket.acquire()
+                async with session.post(self.url, json={"halt": 0, "cmd": cmd}) as response:
+                    data = await response.json(content_type=None)
+            if data.get("error") == "QUERY_LIMIT_EXCEEDED":
+                await asyncio.sleep(self.retry_delay)
+                continue
+            if "error" in data:
+                raise BitrixError(data)
+            if data["result"].get("result_error"):
+                raise BitrixError(data["result"]["result_error"])
+            return data["result"]
+
+    async def fetch(self, filters, progress=None):
+        """Лиды, подходящие хотя бы под один фильтр из filters.
+
+        Первый проход получает первые страницы всех фильтров вместе с общим числом записей,
+        второй - все оставшиеся страницы сразу. progress(готово, всего) вызывается после каждого batch."""
+        leads = {}
+        pages = [(i, 0) for i in range(len(filters))]
+        done = 0
+        total = len(pages)
+        while pages:
+            chunks = [pages[i:i + BATCH_SIZE] for i in range(0, len(pages), BATCH_SIZE)]
+            pages = []
+
+            async def run(chunk):
+                nonlocal done
+                result = await self.batch({
+                    f"f{i}_{start}": ("crm.lead.list", {"filter": filters[i], "select": self.fields, "start": start})
+                    for i, start in chunk})
+                done += len(chunk)
+                if progress:
+                    await progress(done, total)
+                return result
+
+            for chunk, result in zip(chunks, await asyncio.gather(*[run(chunk) for chunk in chunks])):
+                for i, start in chunk:
+                    key = f"f{i}_{start}"
+                    for lead in (result["result"] or {}).get(key) or []:
+                        leads[lead["ID"]] = lead
+                    if start == 0:
+                        remaining = range(PAGE_SIZE, int((result.get("result_total") or {}).get(key, 0)), PAGE_SIZE)
+                        pages += [(i, next_start) for next_start in remaining]
+            total += len(pages)
+        return list(leads.values())
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+
+class LeadCache:
+    """Лиды, хранящиеся в локальной БД и догружаемые из Bitrix24 по мере устаревания.
+
+    Для каждого пользователя запоминается, с какой даты создания его лиды загружены полностью и
+    когда они обновлялись. Если запрошено окно шире загруженного, окно загружается целиком, иначе
+    данные старше max_age дополняются лидами, измененными после прошлой синхронизации."""
+
+    def __init__(self, db, fetcher, max_age):
+        self.db = db
+        self.fetcher = fetcher
+        self.max_age = max_age
+        self.last_sync = None
+        self.last_sync_duration = None
+
+    async def refresh(self, bx_ids, since, progress=None):
+        # Запись тысяч лидов занимает заметное время, поэтому БД - в пуле потоков, а не в цикле событий
+        loop = asyncio.get_running_loop()
+        started = datetime.datetime.now()
+        syncs = await loop.run_in_executor(None, self.db.get_lead_syncs, bx_ids)
+        missing = [bx_id for bx_id in bx_ids if bx_id not in syncs or syncs[bx_id].covered_since > since]
+        stale = [bx_id for bx_id in bx_ids
+                 if bx_id not in missing and started - syncs[bx_id].synced_at > self.max_age]
+        filters = [{">=DATE_CREATE": format_bx_datetime(since), "CREATED_BY_ID": str(bx_id)} for bx_id in missing]
+        filters += [{">DATE_MODIFY": format_bx_datetime(syncs[bx_id].synced_at - SYNC_MARGIN),
+                     "CREATED_BY_ID": str(bx_id)} for bx_id in stale]
+        if not filters:
+            return
+        leads = await self.fetcher.fetch(filters, progress)
+        await loop.run_in_executor(None, self._save, leads, missing, stale, started, since)
+
+    def _save(self, leads, missing, stale, started, since):
+        self.db.save_leads(leads)
+        self.db.update_lead_syncs(missing, started, covered_since=since)
+        self.db.update_lead_syncs(stale, started)
+
+    async def stats(self, bx_ids, since, progress=None):
+        await self.refresh(bx_ids, since, progress)
+        return await asyncio.get_running_loop().run_in_executor(None, self.db.count_leads, bx_ids, since)
+
+    async def sync(self, days):
+        """Фоновое обновление лидов всех зарегистрированных пользователей за последние days дней"""
+        started = time.monotonic()
+        bx_ids = await asyncio.get_running_loop().run_in_executor(None, self.db.get_bx_ids)
+        since = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=days - 1), datetime.time())
+        await self.refresh(bx_ids, since)
+        self.last_sync = datetime.datetime.now()
+        self.last_sync_duration = time.monotonic() - started
+        print(f"Bitrix sync: {len(bx_ids)} users in {self.last_sync_duration:.2f}s")
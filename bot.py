@@ -1,68 +1,215 @@
 import datetime
 import json
 import asyncio
-import time
-
-import telebot
+import functools
+import os
+import signal
+import socket
+import tempfile
+from collections import OrderedDict
+
+from telebot import asyncio_filters, asyncio_helper, types
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.async_telebot import AsyncTeleBot
 from telebot.types import ReplyKeyboardRemove as RemoveMarkup
-from telebot import types
 from sqlalchemy import exc
-import requests
 from bitrix24 import Bitrix24
 
 from database import database_handler
+from bitrix_leads import LeadCache, LeadFetcher
+from broadcast import Broadcaster, RateLimiter
+from export import FORMATS, MAX_DOCUMENT_SIZE, compress, export_answers, export_filename
+from live import LiveResults
+from reports import Report, truncate
+from states import StateMachine, make_state_storage
+from validation import ValidatorCache, duplicate_options
+from webhook import WebhookServer
+from workers import UpdateDispatcher, consume
+from write_behind import WriteBehind
 import bot_config as cfg
 
 
 class Callback:
-    callback_funcs = {}
-    inline_messages = {}
-
-    def __init__(self):
-        pass
-
-    def register_callback(self, message, func, *args):
-        self.delete_old_inline(message.chat.id)
-        key = str(message.chat.id) + str(message.id)
-        self.callback_funcs[key] = [func, args]
-        self.inline_messages[message.chat.id] = message.id
-
-    def run_callback(self, call):
-        bot.answer_callback_query(call.id)
-        bot.delete_message(call.message.chat.id, call.message.id)
-        key = str(call.message.chat.id) + str(call.message.id)
-        try:
-            func, args = self.callback_funcs[key]
-        except KeyError:
+    """Ожидающие нажатия inline-кнопок: LRU-реестр с TTL, который сохраняется в БД и переживает перезапуск.
+
+    Обработчик колбэка должен быть зарегистрирован через @cb.handler, чтобы его можно было восстановить по имени."""
+
+    def __init__(self, max_size=1000, ttl=24 * 60 * 60):
+        self.max_size = max_size
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.callback_funcs = OrderedDict()  # (chat_id, message_id) -> (func, args, created)
+        self.inline_messages = {}
+        self.handlers = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def handler(self, func):
+        self.handlers[func.__name__] = func
+        return func
+
+    def load(self, workers=1, index=0):
+        """Загружает колбэки чатов своего процесса-обработчика (chat_id % workers == index). Вытесненные при
+        загрузке колбэки остаются в БД до истечения TTL: реестр другого процесса может их еще держать"""
+        db.delete_callbacks_before(datetime.datetime.now() - self.ttl)
+        for chat_id, message_id, func_name, args_json, created in db.get_callbacks(workers, index):
+            if func_name in self.handlers:
+                self._store((chat_id, message_id), self.handlers[func_name], tuple(json.loads(args_json)), created)
+
+    def _store(self, key, func, args, created):
+        """Возвращает вытесненные ключи: их колбэки удаляются из БД вызывающим"""
+        self.callback_funcs[key] = (func, args, created)
+        self.callback_funcs.move_to_end(key)
+        self.inline_messages[key[0]] = key[1]
+        expired = datetime.datetime.now() - self.ttl
+        evicted = []
+        while self.callback_funcs:
+            oldest, (_, _, oldest_created) = next(iter(self.callback_funcs.items()))
+            if len(self.callback_funcs) <= self.max_size and oldest_created > expired:
+                break
+            self._remove(oldest)
+            evicted.append(oldest)
+            self.evictions += 1
+        return evicted
+
+    def _remove(self, key):
+        entry = self.callback_funcs.pop(key, None)
+        if self.inline_messages.get(key[0]) == key[1]:
+            del self.inline_messages[key[0]]
+        return entry
+
+    async def register_callback(self, message, func, *args):
+        await self.delete_old_inline(message.chat.id)
+        created = datetime.datetime.now()
+        evicted = self._store((message.chat.id, message.id), func, args, created)
+        await in_db(db.save_callback, message.chat.id, message.id, func.__name__, json.dumps(args), created)
+        for key in evicted:
+            await in_db(db.delete_callback, *key)
+
+    async def run_callback(self, call):
+        await bot.answer_callback_query(call.id)
+        await bot.delete_message(call.message.chat.id, call.message.id)
+        entry = self._remove((call.message.chat.id, call.message.id))
+        await in_db(db.delete_callback, call.message.chat.id, call.message.id)
+        if not entry or entry[2] < datetime.datetime.now() - self.ttl:
+            self.misses += 1
             return
-        func(call, *args)
+        self.hits += 1
+        func, args, _ = entry
+        await func(call, *args)
 
-    def delete_old_inline(self, uid):
+    async def delete_old_inline(self, uid):
         if uid in self.inline_messages:
-            if self.inline_messages[uid]:
-                try:
-                    bot.delete_message(uid, self.inline_messages[uid])
-                except Exception:
-                    pass
-                self.inline_messages[uid] = None
-
+            message_id = self.inline_messages[uid]
+            self._remove((uid, message_id))
+            await in_db(db.delete_callback, uid, message_id)
+            try:
+                await bot.delete_message(uid, message_id)
+            except Exception:
+                pass
+
+    def stats(self):
+        return {"size": len(self.callback_funcs), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class RenderCache:
+    """Готовые к отправке текст и json клавиатуры опроса по (id, версия опроса).
+
+    Рассылка опроса N пользователям отрисовывает и сериализует его один раз; после изменения опроса
+    меняется версия, и старая запись вытесняется как давно не использованная."""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, question):
+        key = (question.id, question.version)
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        rendered = (form_question(question),
+                    get_question_keyboard(question.get_answer_options(), question.optional).to_json())
+        self.items[key] = rendered
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+        return rendered
+
+
+def static_keyboard(build):
+    """Неизменная клавиатура собирается и сериализуется в json один раз"""
+    @functools.wraps(build)
+    def get():
+        if get.markup is None:
+            get.markup = build().to_json()
+        return get.markup
+    get.markup = None
+    return get
+
+
+asyncio_helper.REQUEST_LIMIT = cfg.HTTP_POOL_SIZE
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
 
 db = database_handler.Handler("database/db.db")
-bot = telebot.TeleBot(cfg.TOKEN)
+# В этом потоке крутится цикл событий, ожидание блокировки БД в нем останавливает весь бот
+db.set_thread_busy_timeout(cfg.DB_LOOP_BUSY_TIMEOUT)
+bot = AsyncTeleBot(cfg.TOKEN)
 bx24 = Bitrix24(cfg.BITRIX_URL)
-cb = Callback()
-
-
-def count_lead_stats(leads):
-    print(leads)
-    converted = 0
-    in_work = 0
-    for lead in leads:
-        if lead["STATUS_ID"] == 'CONVERTED':
-            converted += 1
-        if lead["DATE_CLOSED"] == '':
-            in_work += 1
-    leads = len(leads)
+lead_fetcher = LeadFetcher(cfg.BITRIX_URL, cfg.BITRIX_RATE_LIMIT, cfg.BITRIX_CONCURRENCY)
+lead_cache = LeadCache(db, lead_fetcher, datetime.timedelta(seconds=cfg.BITRIX_CACHE_TTL))
+cb = Callback(cfg.CALLBACK_REGISTRY_SIZE, cfg.CALLBACK_TTL)
+render_cache = RenderCache()
+validators = ValidatorCache()
+broadcaster = Broadcaster(RateLimiter(cfg.GLOBAL_RATE_LIMIT, cfg.CHAT_RATE_LIMIT), cfg.BROADCAST_WORKERS,
+                          cfg.BROADCAST_CLAIM_CHUNK)
+question_wakeup = asyncio.Event()
+reminder_wakeup = asyncio.Event()
+answer_writer = WriteBehind(db.save_answers, cfg.WRITE_BEHIND_DELAY, cfg.WRITE_BEHIND_BATCH)
+# Напоминания о разосланных опросах попадают в БД вместе с пачкой доставок, поэтому будим напоминания после нее
+delivery_writer = WriteBehind(db.save_deliveries, cfg.WRITE_BEHIND_DELAY, cfg.WRITE_BEHIND_BATCH,
+                              on_flush=reminder_wakeup.set)
+live_results = LiveResults(lambda question_id, role: render_live(question_id, role),
+                           lambda chat_id, message_id, text: bot.edit_message_text(text, chat_id, message_id),
+                           cfg.LIVE_RESULTS_INTERVAL, cfg.LIVE_RESULTS_TTL)
+
+REMINDER_INTERVAL = datetime.timedelta(seconds=cfg.REMINDER_INTERVAL)
+# Процессы-обработчики запускаются через spawn и заново импортируют модуль, поэтому у каждого свой pid
+SCHEDULER_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+
+async def in_db(func, *args, **kwargs):
+    """Вызывает метод БД в пуле потоков, как Bitrix24 и выгрузку: пока запрос ждет блокировку, занятую другим
+    процессом (до DB_BUSY_TIMEOUT), бот продолжает обрабатывать сообщения"""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+steps = StateMachine(make_state_storage(cfg.STATE_STORAGE, db, cfg.REDIS_URL), in_db)
+
+
+class StepFilter(asyncio_filters.SimpleCustomFilter):
+    """step=True: у чата есть состояние диалога (оно забирается для steps.dispatch). Фильтр func не ждет корутин,
+    а хранилище состояний читается в пуле потоков"""
+    key = "step"
+
+    async def check(self, message):
+        return await steps.claim(message)
+
+
+bot.add_custom_filter(StepFilter())
+
+
+@bot.message_handler(step=True)
+async def next_step(message):
+    await steps.dispatch(message)
+
+
+def count_lead_stats(leads, converted, in_work):
     if leads:
         conversion = f"{(converted / leads * 100):.1f}%"
     else:
@@ -70,38 +217,30 @@ def count_lead_stats(leads):
     return f"Лидов: {leads}\nПродаж: {converted}\nКонверсия: {conversion}\nНезакрытых лидов: {in_work}"
 
 
-def get_leads(ids, days=1):
+async def get_lead_stats(ids, days=1, progress=None):
     days = days - 1
-    then = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime("%Y-%m-%dT00:00:00")
-    leads = []
-    l_ids = len(ids)
-    for i, id_ in enumerate(ids):
-        yield f"Загрузка...{(i / l_ids * 100):.1f}%"
-        filter_ = {'>DATE_CREATE': then,
-                   'CREATED_BY_ID': str(id_)}
-        leads_by_id = bx24.callMethod("crm.lead.list", filter=filter_)
-        time.sleep(0.5)
-        leads += leads_by_id
-    yield leads
+    then = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=days), datetime.time())
+    return await lead_cache.stats([id_ for id_ in ids if id_], then, progress)
 
 
 @bot.message_handler(commands=["bx"])
-def bx1(message):
+async def bx1(message):
     if message.from_user.username not in cfg.admins:
-        bot.send_message(message.from_user.id, "Вы не являетесь администратором")
+        await bot.send_message(message.from_user.id, "Вы не являетесь администратором")
         return
-    bot.send_message(message.from_user.id,
-                     "Роли и пользователи (@имя), статистику для которых нужно получить:",
-                     reply_markup=get_quest3_keyboard())
-    bot.register_next_step_handler(message, bx2)
+    await bot.send_message(message.from_user.id,
+                           "Роли и пользователи (@имя), статистику для которых нужно получить:",
+                           reply_markup=get_quest3_keyboard())
+    await steps.set(message.chat.id, bx2)
 
 
-def bx2(message):
+@steps.step
+async def bx2(message):
     if message.text in ["Отмена", "Назад"]:
-        bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
+        await bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
         return
     if message.text == "Для всех":
-        users = db.get_users()
+        users = await in_db(db.get_users)
         tg_ids = [user.tg_user_id for user in users]
     else:
         tg_ids = []
@@ -112,38 +251,43 @@ def bx2(message):
             if "@" in group:
                 username = group[group.find("@") + 1:].strip()
                 try:
-                    tg_ids.append(db.get_user(username=username).tg_user_id)
+                    tg_ids.append((await in_db(db.get_user, username=username)).tg_user_id)
                 except exc.NoResultFound:
-                    bot.send_message(message.from_user.id, f"@{username} нет в системе")
+                    await bot.send_message(message.from_user.id, f"@{username} нет в системе")
             else:
                 roles.append(group.strip())
 
         for role in roles:
-            tg_ids += db.get_role(role).get_users()
-    bx_ids = [db.get_user(tg_id).bx_id for tg_id in tg_ids]
-    bot.send_message(message.from_user.id, "Для скольки дней получить статистику (включая сегодня)?",
-                     reply_markup=days_keyboard())
-    bot.register_next_step_handler(message, bx3, bx_ids)
+            tg_ids += (await in_db(db.get_role, role)).get_users()
+    bx_ids = await in_db(lambda: [db.get_user(tg_id).bx_id for tg_id in tg_ids])
+    await bot.send_message(message.from_user.id, "Для скольки дней получить статистику (включая сегодня)?",
+                           reply_markup=days_keyboard())
+    await steps.set(message.chat.id, bx3, bx_ids)
 
 
-def bx3(message, ids):
+@steps.step
+async def bx3(message, ids):
     if message.text == "Отмена":
-        bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
+        await bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
         return
 
     days = int(message.text)
-    mid = None
-    for r in get_leads(ids, days):
-        if type(r) == str:
-            if not mid:
-                mid = bot.send_message(message.from_user.id, r).id
-            else:
-                bot.edit_message_text(r, message.from_user.id, mid)
-        else:
-            bot.delete_message(message.from_user.id, mid)
-            bot.send_message(message.from_user.id, count_lead_stats(r), reply_markup=RemoveMarkup())
+    mid = (await bot.send_message(message.from_user.id, "Загрузка...0.0%")).id
+
+    shown = "Загрузка...0.0%"
+
+    async def progress(done, total):
+        nonlocal shown
+        if (text := f"Загрузка...{(done / total * 100):.1f}%") != shown:
+            shown = text
+            await bot.edit_message_text(text, message.from_user.id, mid)
 
+    lead_stats = await get_lead_stats(ids, days, progress)
+    await bot.delete_message(message.from_user.id, mid)
+    await bot.send_message(message.from_user.id, count_lead_stats(*lead_stats), reply_markup=RemoveMarkup())
 
+
+@static_keyboard
 def days_keyboard():
     keyboard = types.ReplyKeyboardMarkup()
     keyboard.row(types.KeyboardButton('30'), types.KeyboardButton('7'), types.KeyboardButton('1'))
@@ -153,65 +297,82 @@ def days_keyboard():
 
 
 @bot.callback_query_handler(func=lambda call: True)
-def callback(call):
-    cb.run_callback(call)
+async def callback(call):
+    await cb.run_callback(call)
 
 
 @bot.message_handler(commands=["help", "start"])
-def start_help(message):
+async def start_help(message):
     if message.chat.id < 0:
-        bot.send_message(message.chat.id, text="Бот для рассылки опросов\nПожалуйста, перейдите в ЛС бота и "
-                                               "напишите /join, чтобы разрешить отправлять вам сообщения.")
+        await bot.send_message(message.chat.id, text="Бот для рассылки опросов\nПожалуйста, перейдите в ЛС бота и "
+                                                     "напишите /join, чтобы разрешить отправлять вам сообщения.")
         return
-    bot.send_message(message.chat.id,
-                     text="Приветствую!\nРегистрация в системе опросов -  /join\n"
-                          "Ваш статус в системе опросов - /status",
-                     reply_markup=get_help_keyboard())
+    await bot.send_message(message.chat.id,
+                           text="Приветствую!\nРегистрация в системе опросов -  /join\n"
+                                "Ваш статус в системе опросов - /status",
+                           reply_markup=get_help_keyboard())
 
 
 @bot.message_handler(commands=["chat_id"])
-def get_chat_id(message):
+async def get_chat_id(message):
     print(message.chat.id)
-    bot.send_message(message.chat.id, text=str(message.chat.id))
+    await bot.send_message(message.chat.id, text=str(message.chat.id))
 
 
 @bot.message_handler(commands=["join"])
-def start_user(message):
+async def start_user(message):
     if message.chat.id < 0:
-        bot.reply_to(message, "Для регистрации в системе необходимо написать именно в личные сообщения боту")
+        await bot.reply_to(message, "Для регистрации в системе необходимо написать именно в личные сообщения боту")
         return
     msg = "Укажите свой ID из BITRIX24:"
-    bot.send_message(message.from_user.id, msg, reply_markup=RemoveMarkup())
-    bot.register_next_step_handler(message, add_id)
+    await bot.send_message(message.from_user.id, msg, reply_markup=RemoveMarkup())
+    await steps.set(message.chat.id, add_id)
 
 
-def add_id(message):
+@steps.step
+async def add_id(message):
     id_ = message.text
-    user = bx24.callMethod("user.get", filter={'ID': id_})
+    user = await asyncio.get_running_loop().run_in_executor(
+        None, lambda: bx24.callMethod("user.get", filter={'ID': id_}))
     if not user:
-        bot.send_message(message.chat.id, "Не удалось найти такого пользователя.")
+        await bot.send_message(message.chat.id, "Не удалось найти такого пользователя.")
         return
     user = user[0]
     name = f"{user['NAME']} {user['LAST_NAME']}"
     msg = f"{name}, верно?"
-    message = bot.send_message(message.chat.id, msg, reply_markup=add_id_keyboard())
-    cb.register_callback(message, add_id2, id_, name)
+    message = await bot.send_message(message.chat.id, msg, reply_markup=add_id_keyboard())
+    await cb.register_callback(message, add_id2, id_, name)
 
 
-def add_id2(call, bx_id, name):
+@cb.handler
+async def add_id2(call, bx_id, name):
     if call.data == "Yes":
         username = name + (f" (@{call.from_user.username})" if call.from_user.username else '')
         tg_user_id = call.from_user.id
         try:
-            db.create_user(tg_user_id, call.from_user.username, username)
+            await in_db(db.create_user, tg_user_id, call.from_user.username, username)
         except exc.IntegrityError:  # Уже был добавлен
             pass
-        db.update_user(call.from_user.id, bx_id=bx_id)
-        bot.send_message(call.from_user.id, "Вы добавлены в систему")
+        await in_db(db.update_user, call.from_user.id, bx_id=bx_id)
+        await bot.send_message(call.from_user.id, "Вы добавлены в систему")
     else:
-        bot.send_message(call.from_user.id, "Регистрация отменена")
+        await bot.send_message(call.from_user.id, "Регистрация отменена")
+
 
+def report_keyboard(has_prev, has_next):
+    if not has_prev and not has_next:
+        return None
+    k = types.InlineKeyboardMarkup()
+    buttons = []
+    if has_prev:
+        buttons.append(types.InlineKeyboardButton(text="◀ Назад", callback_data="prev"))
+    if has_next:
+        buttons.append(types.InlineKeyboardButton(text="Далее ▶", callback_data="next"))
+    k.row(*buttons)
+    return k
 
+
+@static_keyboard
 def add_id_keyboard():
     k = types.InlineKeyboardMarkup()
     k.row(
@@ -222,173 +383,169 @@ def add_id_keyboard():
 
 
 @bot.message_handler(commands=["status"])
-def status(message):
+async def status(message):
     if message.chat.id < 0:
-        bot.reply_to(message, "Функционал доступен в только в ЛС", reply_markup=RemoveMarkup())
+        await bot.reply_to(message, "Функционал доступен в только в ЛС", reply_markup=RemoveMarkup())
         return
     try:
-        user = db.get_user(message.from_user.id)
+        user = await in_db(db.get_user, message.from_user.id)
     except exc.NoResultFound:
-        bot.send_message(message.from_user.id, "Вы не добавлены в систему", reply_markup=RemoveMarkup())
+        await bot.send_message(message.from_user.id, "Вы не добавлены в систему", reply_markup=RemoveMarkup())
     else:
-        bot.send_message(message.from_user.id,
-                         f"{('Роли: ' + ', '.join(user.get_roles()) if user.get_roles() else 'Нет ролей')}; "
-                         f"{('Администратор.' if user.admin else '')}", reply_markup=RemoveMarkup())
+        await bot.send_message(message.from_user.id,
+                               f"{('Роли: ' + ', '.join(user.get_roles()) if user.get_roles() else 'Нет ролей')}; "
+                               f"{('Администратор.' if user.admin else '')}", reply_markup=RemoveMarkup())
 
 
 @bot.message_handler(commands=["admin"])
-def start_admin(message):
+async def start_admin(message):
     if message.chat.id < 0:
-        bot.reply_to(message, "Функционал администратора доступен только в ЛС бота")
+        await bot.reply_to(message, "Функционал администратора доступен только в ЛС бота")
         return
     if message.from_user.username not in cfg.admins:
-        bot.send_message(message.from_user.id, "Вы не являетесь администратором")
-        return
-    bot.send_message(message.from_user.id, "/quest - создать опрос\n"
-                                           "/users - список пользователей\n"
-                                           "/roles - список ролей\n"
-                                           "/quests - список опросов\n"
-                                           "/stats <id опроса> - статистика по опросу\n"
-                                           "/userstats <@username пользователя> - статистика пользователя\n"
-                                           "/rolestats <id опроса> <роль> - статистика по опросу конкретной роли\n"
-                                           "/mkrole <@username> <роль> - назначить роль\n"
-                                           "/rmrole <@username> <роль> - снять роль\n"
-                                           "/delrole <роль> - удалить роль как таковую\n"
-                                           "/bx - просмотр статистики из bitrix",
-                     reply_markup=RemoveMarkup())
+        await bot.send_message(message.from_user.id, "Вы не являетесь администратором")
+        return
+    await bot.send_message(message.from_user.id, "/quest - создать опрос\n"
+                                                 "/users - список пользователей\n"
+                                                 "/roles - список ролей\n"
+                                                 "/quests - список опросов\n"
+                                                 "/stats <id опроса> - статистика по опросу\n"
+                                                 "/userstats <@username пользователя> - статистика пользователя\n"
+                                                 "/rolestats <id опроса> <роль> - статистика по опросу "
+                                                 "конкретной роли\n"
+                                                 "/live <id опроса> [роль] - результаты опроса, обновляемые по мере "
+                                                 "поступления ответов\n"
+                                                 "/mkrole <@username> <роль> - назначить роль\n"
+                                                 "/rmrole <@username> <роль> - снять роль\n"
+                                                 "/delrole <роль> - удалить роль как таковую\n"
+                                                 "/export <id опроса|all> [csv|parquet] - выгрузить ответы файлом\n"
+                                                 "/bx - просмотр статистики из bitrix",
+                           reply_markup=RemoveMarkup())
 
 
 @bot.message_handler(commands=["roles"])
-def view_roles(message):
+async def view_roles(message):
     if message.from_user.username not in cfg.admins:
         return
 
-    roles = db.get_roles()
-    msg = "\n".join(
-        [f"""{role.name}: {', '.join(
-            [db.get_user(tg_user_id=user_id).user_str for user_id in role.get_users()]
-        )} """ for role in roles]
-    )
-    if not msg:
-        msg = "Нет ролей"
-    bot.send_message(message.from_user.id, msg)
+    await send_report(message.from_user.id, "roles")
 
 
 @bot.message_handler(commands=["users"])
-def view_users(message):
+async def view_users(message):
     if message.from_user.username not in cfg.admins:
         return
 
-    users = db.get_users()
-
-    msg = "\n".join(
-        [f"""{user.user_str}: {', '.join(user.get_roles())}"""
-         for user in users]
-    )
-    if not msg:
-        msg = "Нет пользователей"
-    bot.send_message(message.from_user.id, msg)
+    await send_report(message.from_user.id, "users")
 
 
 @bot.message_handler(commands=["mkrole"])
-def mkrole(message):
+async def mkrole(message):
     if message.from_user.username not in cfg.admins:
         return
 
     _, user, role = parse(message.text, 3)
     if not (user and role):
-        bot.send_message(message.from_user.id, "Ошибка форматирования")
+        await bot.send_message(message.from_user.id, "Ошибка форматирования")
         return
 
     role = role.strip()
 
     try:
-        db.mkrole(user.replace("@", ""), role)
+        await in_db(db.mkrole, user.replace("@", ""), role)
     except exc.NoResultFound:
-        bot.send_message(message.from_user.id, "В системе нет такого пользователя")
+        await bot.send_message(message.from_user.id, "В системе нет такого пользователя")
     else:
-        bot.send_message(message.from_user.id, "Роль установлена")
+        await bot.send_message(message.from_user.id, "Роль установлена")
 
 
 @bot.message_handler(commands=["rmrole"])
-def rmrole(message):
+async def rmrole(message):
     if message.from_user.username not in cfg.admins:
         return
 
     _, user, role = parse(message.text, 3)
     if not (user and role):
-        bot.send_message(message.from_user.id, "Ошибка форматирования")
+        await bot.send_message(message.from_user.id, "Ошибка форматирования")
         return
 
     role = role.strip()
 
     try:
-        db.rmrole(user.replace("@", ""), role)
+        await in_db(db.rmrole, user.replace("@", ""), role)
     except exc.NoResultFound:
-        bot.send_message(message.from_user.id, "В системе нет такого пользователя")
+        await bot.send_message(message.from_user.id, "В системе нет такого пользователя")
     else:
-        bot.send_message(message.from_user.id, "Роль снята")
+        await bot.send_message(message.from_user.id, "Роль снята")
 
 
 @bot.message_handler(commands=["quest"])
-def quest(message):
+async def quest(message):
     if message.from_user.username not in cfg.admins:
         return
 
-    question = database_handler.Question()
+    question = {}
 
-    bot.send_message(message.from_user.id, "Текст опроса:", reply_markup=get_quest_keyboard())
-    bot.register_next_step_handler(message, quest2, question)
+    await bot.send_message(message.from_user.id, "Текст опроса:", reply_markup=get_quest_keyboard())
+    await steps.set(message.chat.id, quest2, question)
 
 
-def quest2(message, question, back=False):
+@steps.step
+async def quest2(message, question, back=False):
     if not back:
         if message.text == "Отмена":
-            bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
+            await bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
             return
 
-        question.text = message.text
-    bot.send_message(message.from_user.id, "Варианты ответа (через точку с запятой):",
-                     reply_markup=get_quest2_keyboard())
-    bot.register_next_step_handler(message, quest3, question)
+        question["text"] = message.text
+    await bot.send_message(message.from_user.id, "Варианты ответа (через точку с запятой):",
+                           reply_markup=get_quest2_keyboard())
+    await steps.set(message.chat.id, quest3, question)
 
 
-def quest3(message, question, back=False):
+@steps.step
+async def quest3(message, question, back=False):
     if not back:
         if message.text == "Назад":
-            quest(message, question)
+            await quest(message)
             return
         if message.text == "Отмена":
-            bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
+            await bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
             return
 
         if message.text == "Опрос с развернутым ответом":
-            question.answer_options_json = json.dumps([])
+            question["answer_options"] = []
         else:
             options = message.text.split(';')
             for i, option in enumerate(options):
                 options[i] = option.strip(" ")
-            question.answer_options_json = json.dumps(options)
+            if duplicates := duplicate_options(options):
+                await bot.send_message(message.from_user.id, "Варианты ответа не должны повторяться (без учета "
+                                                             f"регистра и пробелов): {', '.join(duplicates)}")
+                await quest2(message, question, True)
+                return
+            question["answer_options"] = options
 
-    bot.send_message(message.from_user.id,
-                     "Роли и пользователи (@имя), для которых предназначен опрос (через точку с запятой):",
-                     reply_markup=get_quest3_keyboard())
-    bot.register_next_step_handler(message, quest4, question)
+    await bot.send_message(message.from_user.id,
+                           "Роли и пользователи (@имя), для которых предназначен опрос (через точку с запятой):",
+                           reply_markup=get_quest3_keyboard())
+    await steps.set(message.chat.id, quest4, question)
 
 
-def quest4(message, question, back=False):
+@steps.step
+async def quest4(message, question, back=False):
     if not back:
         if message.text == "Назад":
-            quest2(message, question, True)
+            await quest2(message, question, True)
             return
         if message.text == "Отмена":
-            bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
+            await bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
             return
 
         if message.text == "Для всех":
-            question.for_all = True
+            question["for_all"] = True
         else:
-            question.for_all = False
+            question["for_all"] = False
             groups = message.text.split(";")
 
             roles = []
@@ -398,223 +555,296 @@ def quest4(message, question, back=False):
                 if "@" in group:
                     username = group[group.find("@") + 1:].strip()
                     try:
-                        users.append(db.get_user(username=username).tg_user_id)
+                        users.append((await in_db(db.get_user, username=username)).tg_user_id)
                     except exc.NoResultFound:
-                        bot.send_message(message.from_user.id, f"@{username} нет в системе")
+                        await bot.send_message(message.from_user.id, f"@{username} нет в системе")
                 else:
                     roles.append(group.strip())
 
-            question.users_for_json = json.dumps(users)
-            question.roles_for_json = json.dumps(roles)
+            question["users_for"] = users
+            question["roles_for"] = roles
 
-        bot.send_message(message.from_user.id,
-                         "Это обязательный вопрос?",
-                         reply_markup=get_quest4_keyboard())
-        bot.register_next_step_handler(message, quest5, question)
+    await bot.send_message(message.from_user.id,
+                           "Это обязательный вопрос?",
+                           reply_markup=get_quest4_keyboard())
+    await steps.set(message.chat.id, quest5, question)
 
 
-def quest5(message, question, back=False):
+@steps.step
+async def quest5(message, question, back=False):
     if not back:
         if message.text == "Назад":
-            quest3(message, question, True)
+            await quest3(message, question, True)
             return
         if message.text == "Отмена":
-            bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
+            await bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
             return
 
         if message.text == "Да":
-            question.optional = False
+            question["optional"] = False
         elif message.text == "Нет":
-            question.optional = True
+            question["optional"] = True
         else:
-            bot.send_message(message.from_user.id, "Напишите, да или нет")
-            quest4(message, question, True)
+            await bot.send_message(message.from_user.id, "Напишите, да или нет")
+            await quest4(message, question, True)
             return
 
-    bot.send_message(message.from_user.id,
-                     "Введите дату и время отправки опроса в формате ДД.ММ.ГГГГ ЧЧ:ММ",
-                     reply_markup=get_quest5_keyboard())
-    bot.register_next_step_handler(message, quest6, question)
+    await bot.send_message(message.from_user.id,
+                           "Введите дату и время отправки опроса в формате ДД.ММ.ГГГГ ЧЧ:ММ",
+                           reply_markup=get_quest5_keyboard())
+    await steps.set(message.chat.id, quest6, question)
 
 
-def quest6(message, question, back=False):
+@steps.step
+async def quest6(message, question, back=False):
     if not back:
         if message.text == "Назад":
-            quest3(message, question, True)
+            await quest4(message, question, True)
             return
         if message.text == "Отмена":
-            bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
+            await bot.send_message(message.from_user.id, "Отменено.", reply_markup=RemoveMarkup())
             return
 
         if message.text == "Отправить прямо сейчас":
-            question.send_datetime = datetime.datetime.now()
+            send_datetime = datetime.datetime.now()
         else:
             try:
                 date, time_ = message.text.split(" ")
                 day, month, year = map(int, date.split("."))
                 hour, minute = map(int, time_.split(":"))
 
-                question.send_datetime = datetime.datetime(year, month, day, hour, minute, 0)
+                send_datetime = datetime.datetime(year, month, day, hour, minute, 0)
             except Exception:
-                bot.send_message(message.from_user.id,
-                                 "Ошибка форматирования, повторите",
-                                 reply_markup=get_quest5_keyboard())
-                quest5(message, question, True)
+                await bot.send_message(message.from_user.id,
+                                       "Ошибка форматирования, повторите",
+                                       reply_markup=get_quest5_keyboard())
+                await quest5(message, question, True)
                 return
 
-        db.create_question(question)
-        bot.send_message(message.from_user.id,
-                         "Опрос добавлен!",
-                         reply_markup=RemoveMarkup())
+        await in_db(db.create_question, database_handler.Question(
+            text=question["text"], for_all=question["for_all"], roles_for=question.get("roles_for", []),
+            users_for=question.get("users_for", []), answer_options=question["answer_options"],
+            optional=question["optional"], send_datetime=send_datetime))
+        wake_question_sender()
+        await bot.send_message(message.from_user.id,
+                               "Опрос добавлен!",
+                               reply_markup=RemoveMarkup())
 
 
-def ask(tg_user_id, msg, keyboard, question):
-    message = bot.send_message(tg_user_id, msg, reply_markup=keyboard)
-    re_ask = lambda: ask(tg_user_id, msg, keyboard, question)
-    bot.register_next_step_handler(message, handle_answer, question, re_ask)
+async def send_question(tg_user_id, msg, keyboard, question):
     try:
-        loop = asyncio.get_running_loop()
-        loop.create_task(notify_if_not_respond(tg_user_id))
+        sent = await bot.send_message(tg_user_id, msg, reply_markup=keyboard)
+    except ApiTelegramException as e:
+        # После 429 рассылка повторит отправку, в остальных случаях (бот заблокирован и т.п.) опрос
+        # до пользователя не дойдет, и его доставка закрывается
+        if e.error_code != 429:
+            await in_db(db.skip_question, tg_user_id, question.id)
+        raise
     except Exception:
-        pass
+        await in_db(db.skip_question, tg_user_id, question.id)
+        raise
+    await delivery_writer.put((tg_user_id, question.id, sent.message_id, datetime.datetime.now() + REMINDER_INTERVAL))
 
 
-async def notify_if_not_respond(tg_user_id):
-    while True:
-        await asyncio.sleep(30 * 60)
-        user = db.get_user(tg_user_id)
-        if (not user.answered_last_question) and user.last_question_notifications < 2:
-            bot.send_message(user.tg_user_id, "Ответьте на опрос, пожалуйста!")
-            db.update_user(user.tg_user_id, last_question_notifications=user.last_question_notifications + 1)
-        elif (not user.answered_last_question) and user.last_question_notifications == 2:
-            db.update_user(user.tg_user_id, True, 0)
-            return
-        else:
-            return
+async def send_reminder(tg_user_id):
+    await bot.send_message(tg_user_id, "Ответьте на опрос, пожалуйста!")
+
+
+async def get_validator(pending):
+    return await validators.get(pending.question_id, pending.version,
+                                lambda: in_db(db.get_question, pending.question_id))
+
+
+def route_answer(message, pending):
+    """Опрос, на который отвечает сообщение: по реплаю на сообщение с опросом, иначе тот, чья клавиатура
+    показывалась последней"""
+    if message.reply_to_message:
+        for question in pending:
+            if question.message_id == message.reply_to_message.message_id:
+                return question
+    return max(pending, key=lambda question: (question.presented or datetime.datetime.min, question.message_id or 0))
+
+
+async def present_next(tg_user_id, pending, text=None):
+    """Показывает клавиатуру самого старого из оставшихся без ответа опросов"""
+    if not pending:
+        if text:
+            await bot.send_message(tg_user_id, text, reply_markup=RemoveMarkup())
+        return
+    question = (await get_validator(pending[0])).question
+    msg, keyboard = render_cache.get(question)
+    await bot.send_message(tg_user_id, (f"{text}\n\n" if text else "") + f"Ждем ответа на опрос:\n\n{msg}",
+                           reply_markup=keyboard)
+    await in_db(db.present_question, tg_user_id, question.id)
 
 
-def handle_answer(message, question, re_ask):
+@bot.message_handler(func=lambda message: message.chat.type == "private" and not message.text.startswith("/"))
+async def handle_answer(message):
+    pending = await in_db(db.get_pending, message.from_user.id)
+    if not pending:
+        return
+    answered = route_answer(message, pending)
+    rest = [question for question in pending if question != answered]
+    validator = await get_validator(answered)
+    question = validator.question
     if question.optional and message.text == 'Пропустить':
+        await in_db(db.skip_question, message.from_user.id, question.id)
+        await present_next(message.from_user.id, rest)
         return
     print(f"answered: {message.text}")
-    if options := question.get_answer_options():
-        if message.text not in options:
-            bot.send_message(message.from_user.id, "Ответ не соответствует предложенным вариантам")
-            re_ask()
+    option_id = None
+    if validator.options:
+        option_id = validator.option_id(message.text)
+        if option_id is None:
+            await bot.send_message(message.from_user.id, "Ответ не соответствует предложенным вариантам",
+                                   reply_to_message_id=answered.message_id, allow_sending_without_reply=True,
+                                   reply_markup=render_cache.get(question)[1])
+            await in_db(db.present_question, message.from_user.id, question.id)
             return
 
-    db.create_answer(message.from_user.id, question.id, message.text)
-    db.update_user(message.from_user.id, True, 0)
-    bot.send_message(message.from_user.id, "Спасибо за ответ!", reply_markup=RemoveMarkup())
+    await answer_writer.put((message.from_user.id, question.id, option_id, None if validator.options else message.text))
+    await present_next(message.from_user.id, rest, "Спасибо за ответ!")
 
 
 @bot.message_handler(commands=["quests"])
-def quests(message):
-    questions = db.get_questions()
-    if not questions:
-        bot.send_message(message.from_user.id, "Нет опросов")
-        return
-    else:
-        msg = ""
-        for question in questions:
-            msg += f"{question.id}. {question.text}\n"
-        bot.send_message(message.from_user.id, msg)
+async def quests(message):
+    await send_report(message.from_user.id, "quests")
 
 
 @bot.message_handler(commands=["stats"])
-def stats(message):
+async def stats(message):
     if message.from_user.username not in cfg.admins:
         return
 
     _, question_id = parse(message.text, 2)
     try:
         question_id = int(question_id)
-        question = db.get_question(question_id)
+        question = await in_db(db.get_question, question_id)
     except ValueError:
-        bot.send_message(message.from_user.id, "Ошибка форматирования")
+        await bot.send_message(message.from_user.id, "Ошибка форматирования")
         return
     except exc.NoResultFound:
-        bot.send_message(message.from_user.id, "Нет такого опроса")
+        await bot.send_message(message.from_user.id, "Нет такого опроса")
         return
-    msg = question.text + "\n\n"
-    answers = db.get_answers(question.id)
-    if options := question.get_answer_options():
-        for option in options:
-            msg += f"{option} - {sum([int(answer.text == option) for answer in answers])} ответов: " \
-                   f"{', '.join([db.get_user(answer.user_id).user_str for answer in answers if answer.text == option])}\n"
-
-    else:
-        for answer in answers:
-            msg += f"{db.get_user(answer.user_id).user_str} - {answer.text}\n"
-
-    bot.send_message(message.from_user.id, msg)
+    await send_report(message.from_user.id, "stats", question.id, None)
 
 
 @bot.message_handler(commands=["userstats"])
-def user_stats(message):
+async def user_stats(message):
     if message.from_user.username not in cfg.admins:
         return
 
     try:
         _, username = parse(message.text, 2)
-        user = db.get_user(username=username.replace("@", ''))
+        user = await in_db(db.get_user, username=username.replace("@", ''))
     except exc.NoResultFound:
-        bot.send_message(message.from_user.id, "Пользователь не найден")
+        await bot.send_message(message.from_user.id, "Пользователь не найден")
         return
     except Exception:
-        bot.send_message(message.from_user.id, "Ошибка форматирования")
+        await bot.send_message(message.from_user.id, "Ошибка форматирования")
         return
 
-    answers = db.get_answers(tg_user_id=user.tg_user_id)
-    msg = f"Статистика {user.user_str}\n"
-    if not answers:
-        msg += "Нет ответов"
-    for answer in answers:
-        msg += f"{db.get_question(answer.question_id).text} - {answer.text}\n"
-    bot.send_message(message.from_user.id, msg)
+    await send_report(message.from_user.id, "userstats", user.tg_user_id)
 
 
 @bot.message_handler(commands=["rolestats"])
-def role_stats(message):
+async def role_stats(message):
     if message.from_user.username not in cfg.admins:
         return
 
     try:
         _, question_id, role = parse(message.text, 3)
         question_id = int(question_id)
-        question = db.get_question(question_id)
+        question = await in_db(db.get_question, question_id)
     except exc.NoResultFound:
-        bot.send_message(message.from_user.id, "Нет такого опроса")
+        await bot.send_message(message.from_user.id, "Нет такого опроса")
         return
     except Exception:
-        bot.send_message(message.from_user.id, "Ошибка форматирования")
+        await bot.send_message(message.from_user.id, "Ошибка форматирования")
         return
 
-    msg = question.text + "\n\n"
-    answers = db.get_answers(question.id, role=role)
-    if options := question.get_answer_options():
-        for option in options:
-            msg += f"{option} - {sum([int(answer.text == option) for answer in answers])} ответов " \
-                   f"({', '.join([db.get_user(answer.user_id).user_str for answer in answers])})\n"
+    await send_report(message.from_user.id, "stats", question.id, role)
 
-    else:
-        for answer in answers:
-            msg += f"{db.get_user(answer.user_id).user_str} - {answer.text}"
 
-    bot.send_message(message.from_user.id, msg)
+@bot.message_handler(commands=["live"])
+async def live_stats(message):
+    if message.from_user.username not in cfg.admins:
+        return
+
+    try:
+        _, question_id, *role = message.text.split(maxsplit=2)
+        question = await in_db(db.get_question, int(question_id))
+    except ValueError:
+        await bot.send_message(message.from_user.id, "Ошибка форматирования")
+        return
+    except exc.NoResultFound:
+        await bot.send_message(message.from_user.id, "Нет такого опроса")
+        return
+    if not question.get_answer_options():
+        await bot.send_message(message.from_user.id, "У опроса нет вариантов ответа")
+        return
+
+    role = role[0] if role else None
+    text = await render_live(question.id, role)
+    sent = await bot.send_message(message.from_user.id, text)
+    live_results.watch(sent.chat.id, sent.id, question.id, role, text)
+
+
+@bot.message_handler(commands=["export"])
+async def export(message):
+    if message.from_user.username not in cfg.admins:
+        return
+
+    try:
+        _, target, *fmt = message.text.split()
+        question_id = None if target == "all" else (await in_db(db.get_question, int(target))).id
+        fmt = fmt[0] if fmt else "csv"
+        if fmt not in FORMATS:
+            raise ValueError(fmt)
+    except ValueError:
+        await bot.send_message(message.from_user.id, "Ошибка форматирования")
+        return
+    except exc.NoResultFound:
+        await bot.send_message(message.from_user.id, "Нет такого опроса")
+        return
+
+    # Выгрузка идет в пуле потоков, чтобы не останавливать обработку остальных сообщений
+    running_loop = asyncio.get_running_loop()
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    files = [path]
+    filename = export_filename(question_id, fmt)
+    try:
+        rows = await running_loop.run_in_executor(None, export_answers, db, path, question_id, fmt)
+        if os.path.getsize(path) > MAX_DOCUMENT_SIZE:
+            path = await running_loop.run_in_executor(None, compress, path)
+            files.append(path)
+            filename += ".gz"
+        if os.path.getsize(path) > MAX_DOCUMENT_SIZE:
+            await bot.send_message(message.from_user.id, f"Выгрузка ({rows} ответов) слишком велика для отправки, "
+                                                         f"воспользуйтесь командой python export.py")
+            return
+        with open(path, "rb") as file:
+            await bot.send_document(message.from_user.id, file, caption=f"Ответов: {rows}",
+                                    visible_file_name=filename)
+    except ImportError:
+        await bot.send_message(message.from_user.id, "Выгрузка в Parquet недоступна: не установлен pyarrow")
+    finally:
+        for file in files:
+            os.remove(file)
 
 
 @bot.message_handler(commands=["delrole"])
-def delrole(message):
+async def delrole(message):
     if message.from_user.username not in cfg.admins:
         return
     _, role = parse(message.text, 2)
     try:
-        db.remove_role(role)
+        await in_db(db.remove_role, role)
     except exc.NoResultFound:
-        bot.send_message(message.from_user.id, "Такой роли нет")
+        await bot.send_message(message.from_user.id, "Такой роли нет")
     else:
-        bot.send_message(message.from_user.id, "Роль удалена")
+        await bot.send_message(message.from_user.id, "Роль удалена")
 
 
 """Utils:"""
@@ -632,6 +862,61 @@ def form_question(question):
     return msg
 
 
+async def render_live(question_id, role):
+    return truncate(await in_db(form_stats_header, question_id, role))
+
+
+def form_stats_header(question_id, role):
+    question = db.get_question(question_id)
+    msg = question.text + "\n\n"
+    if options := question.get_answer_options():
+        counts = db.get_tallies(question.id, role)
+        for option_id, option in enumerate(options):
+            msg += f"{option} - {counts.get(option_id, 0)} ответов\n"
+        msg += "\n"
+    return msg
+
+
+def form_role_member(row, prev):
+    role, _, user_str = row
+    msg = f"{role}:" if prev is None or prev[0] != role else ""
+    if user_str:
+        msg += ("\n" if msg else "") + f"  {user_str}"
+    return msg
+
+
+reports = {
+    "users": Report(db.get_users, lambda user: user.tg_user_id,
+                    lambda user, prev: f"{user.user_str}: {', '.join(user.get_roles())}", empty="Нет пользователей"),
+    "roles": Report(db.get_role_members, lambda row: [row[0], row[1]], form_role_member, empty="Нет ролей"),
+    "quests": Report(db.get_question_texts, lambda row: row[0], lambda row, prev: f"{row[0]}. {row[1]}",
+                     empty="Нет опросов"),
+    "stats": Report(lambda after, limit, question_id, role:
+                    db.get_answers_with_users(question_id, role, after, limit), lambda row: row[0],
+                    lambda row, prev: f"{row[1]} - {row[2]}", header=form_stats_header, empty="Нет ответов"),
+    "userstats": Report(lambda after, limit, tg_user_id: db.get_user_answers(tg_user_id, after, limit),
+                        lambda row: row[0], lambda row, prev: f"{row[1]} - {row[2]}",
+                        header=lambda tg_user_id: f"Статистика {db.get_user(tg_user_id).user_str}\n",
+                        empty="Нет ответов"),
+}
+
+
+async def send_report(chat_id, name, *params, starts=(None,)):
+    """Отправляет страницу отчета, начинающуюся после ключа starts[-1].
+    starts - ключи начала всех открытых до нее страниц, по ним кнопка "назад" возвращается на предыдущую"""
+    msg, last_key, has_next = await in_db(reports[name].page, params, starts[-1])
+    keyboard = report_keyboard(len(starts) > 1, has_next)
+    message = await bot.send_message(chat_id, msg, reply_markup=keyboard)
+    if keyboard:
+        await cb.register_callback(message, report_page, name, params, list(starts), last_key)
+
+
+@cb.handler
+async def report_page(call, name, params, starts, last_key):
+    starts = starts + [last_key] if call.data == "next" else starts[:-1]
+    await send_report(call.message.chat.id, name, *params, starts=starts)
+
+
 def parse(text, n):
     for i in range(n - 1):
         part, text = text[:text.find(" ")], text[text.find(" ") + 1:]
@@ -647,6 +932,7 @@ def msg_user_to_username(user):
 """Keyboards:"""
 
 
+@static_keyboard
 def get_help_keyboard():
     keyboard = types.ReplyKeyboardMarkup()
     key_join = types.KeyboardButton('/join')
@@ -655,6 +941,7 @@ def get_help_keyboard():
     return keyboard
 
 
+@static_keyboard
 def get_quest_keyboard():
     keyboard = types.ReplyKeyboardMarkup()
     key_cancel = types.KeyboardButton('Отмена')
@@ -662,6 +949,7 @@ def get_quest_keyboard():
     return keyboard
 
 
+@static_keyboard
 def get_quest2_keyboard():
     keyboard = types.ReplyKeyboardMarkup()
     key_no_options = types.KeyboardButton('Опрос с развернутым ответом')
@@ -672,6 +960,7 @@ def get_quest2_keyboard():
     return keyboard
 
 
+@static_keyboard
 def get_quest3_keyboard():
     keyboard = types.ReplyKeyboardMarkup()
     key_no_options = types.KeyboardButton('Для всех')
@@ -682,6 +971,7 @@ def get_quest3_keyboard():
     return keyboard
 
 
+@static_keyboard
 def get_quest4_keyboard():
     keyboard = types.ReplyKeyboardMarkup()
     key_yes = types.KeyboardButton('Да')
@@ -693,6 +983,7 @@ def get_quest4_keyboard():
     return keyboard
 
 
+@static_keyboard
 def get_quest5_keyboard():
     keyboard = types.ReplyKeyboardMarkup()
     key_now = types.KeyboardButton('Отправить прямо сейчас')
@@ -703,6 +994,7 @@ def get_quest5_keyboard():
     return keyboard
 
 
+@static_keyboard
 def get_admin_keyboard():
     keyboard = types.ReplyKeyboardMarkup()
     key_join = types.KeyboardButton('/join')
@@ -725,49 +1017,162 @@ def get_question_keyboard(options, optional):
 
 
 def main():
-    loop = asyncio.get_event_loop()
-    loop.create_task(polling_coro())
-    loop.create_task(question_coro())
-    loop.run_forever()
+    if cfg.WORKERS > 1:
+        run_workers()
+        return
+    cb.load()
+    loop.create_task(webhook_coro() if cfg.WEBHOOK_URL else polling_coro())
+    loop.create_task(scheduler_coro())
+    run_forever()
+
+
+def run_workers():
+    dispatcher = UpdateDispatcher(worker_main, cfg.WORKERS, cfg.WORKER_QUEUE_SIZE)
+    dispatcher.start()
+    try:
+        loop.run_until_complete(dispatcher_coro(dispatcher))
+    finally:
+        dispatcher.stop()
+
+
+def worker_main(source, index):
+    """Процесс-обработчик номер index: обновления его чатов приходят от диспетчера главного процесса"""
+    cb.load(cfg.WORKERS, index)
+    server = WebhookServer(bot, None, workers=cfg.WEBHOOK_WORKERS, queue_size=cfg.WEBHOOK_QUEUE_SIZE)
+    loop.create_task(server.run_workers())
+    loop.create_task(consume(source, server))
+    loop.create_task(scheduler_coro())
+    run_forever()
+
+
+def run_forever():
+    """Крутит цикл до Ctrl+C или SIGTERM, после чего дописывает накопленные ответы и доставки в БД
+    и отпускает аренду планировщика, чтобы ее сразу подхватил другой процесс"""
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.create_task(answer_writer.run())
+    loop.create_task(delivery_writer.run())
+    loop.create_task(live_results.run())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(answer_writer.close())
+        loop.run_until_complete(delivery_writer.close())
+        db.release_lease("scheduler", SCHEDULER_OWNER)
 
 
 async def polling_coro():
     print("Bot is running")
-    while True:
-        try:
-            loop = asyncio.get_running_loop()
-            polling = loop.run_in_executor(None, bot.polling)
-            await polling
-        except requests.exceptions.ReadTimeout:
-            print("renewing connection")
+    await bot.polling(non_stop=True)
+
+
+async def set_webhook():
+    path = f"/{cfg.TOKEN.split(':')[0]}"
+    await bot.remove_webhook()
+    await bot.set_webhook(cfg.WEBHOOK_URL.rstrip("/") + path, secret_token=cfg.WEBHOOK_SECRET or None)
+    return path
+
+
+async def webhook_coro():
+    path = await set_webhook()
+    server = WebhookServer(bot, path, cfg.WEBHOOK_SECRET, cfg.WEBHOOK_WORKERS, cfg.WEBHOOK_QUEUE_SIZE)
+    await server.serve(cfg.WEBHOOK_HOST, cfg.WEBHOOK_PORT)
+
+
+async def dispatcher_coro(dispatcher):
+    if cfg.WEBHOOK_URL:
+        path = await set_webhook()
+        await dispatcher.serve(cfg.WEBHOOK_HOST, cfg.WEBHOOK_PORT, path, cfg.WEBHOOK_SECRET)
+    else:
+        await bot.remove_webhook()
+        print("Bot is running")
+        await dispatcher.poll(cfg.TOKEN)
+
+
+async def scheduler_coro():
+    """Рассылки и синхронизацию с Bitrix24 ведет только процесс, который держит аренду планировщика"""
+    tasks = []
+    try:
+        while True:
+            if await in_db(db.acquire_lease, "scheduler", SCHEDULER_OWNER, cfg.SCHEDULER_LEASE_TTL):
+                if not tasks:
+                    print(f"Scheduler lease acquired by {SCHEDULER_OWNER}")
+                    tasks = [loop.create_task(question_coro()), loop.create_task(reminder_coro())]
+                    if cfg.BITRIX_SYNC_INTERVAL:
+                        tasks.append(loop.create_task(bitrix_sync_coro()))
+            elif tasks:
+                print(f"Scheduler lease lost by {SCHEDULER_OWNER}")
+                for task in tasks:
+                    task.cancel()
+                tasks = []
+            await asyncio.sleep(cfg.SCHEDULER_LEASE_TTL / 3)
+    finally:
+        if tasks:
+            for task in tasks:
+                task.cancel()
+            db.release_lease("scheduler", SCHEDULER_OWNER)
+
+
+def wake_question_sender():
+    question_wakeup.set()
 
 
 async def question_coro():
     print("Question sender is running")
     while True:
-        question = db.get_outdated_question()
-        if question:
-            print("Outdated question was found")
-            msg = form_question(question)
-            keyboard = get_question_keyboard(question.get_answer_options(), question.optional)
-
-            users = db.get_users()
-            already_sent = question.get_sent_to()
-            users_to_send = []
-            sent = True
-            for user in users:
-                if question.for_all or user.tg_user_id in question.get_users_for() or \
-                        (True in [role in question.get_roles_for() for role in user.get_roles()]):
-                    if user.tg_user_id not in already_sent and user.answered_last_question:
-                        users_to_send.append(user.tg_user_id)
-                        ask(user.tg_user_id, msg, keyboard, question)
-                        db.update_user(user.tg_user_id, answered_last_question=False)
-                    else:
-                        sent = False
-            already_sent += users_to_send
-            db.update_question(question.id, already_sent, sent)
-
-        await asyncio.sleep(10)
+        question_wakeup.clear()
+        for question in await in_db(db.get_outdated_questions):
+            print(f"Sending question {question.id}")
+            msg, keyboard = render_cache.get(question)
+
+            recipients = await in_db(db.get_recipients, question.id)
+            if recipients:
+                await broadcaster.run(recipients,
+                                      lambda tg_user_id: send_question(tg_user_id, msg, keyboard, question),
+                                      claim=lambda tg_user_ids: db.mark_sent(question.id, tg_user_ids))
+            await in_db(db.update_question, question.id, sent=True)
+
+        # Спим до ближайшего неразосланного опроса (наступивший во время рассылки уже просрочен - не спим);
+        # новый опрос будит раньше
+        next_send = await in_db(db.get_next_send_datetime)
+        timeout = max((next_send - datetime.datetime.now()).total_seconds(), 0) if next_send else None
+        if cfg.WORKERS > 1:
+            # Опросы из других процессов не будят этот процесс, поэтому БД проверяется периодически
+            timeout = cfg.SCHEDULER_POLL_INTERVAL if timeout is None else min(timeout, cfg.SCHEDULER_POLL_INTERVAL)
+        try:
+            await asyncio.wait_for(question_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def reminder_coro():
+    print("Reminder scheduler is running")
+    while True:
+        to_notify, processed = await in_db(db.process_due_reminders, datetime.datetime.now(), REMINDER_INTERVAL,
+                                           cfg.REMINDER_COUNT)
+        if to_notify:
+            await broadcaster.run(to_notify, send_reminder)
+        if processed:
+            continue
+
+        reminder_wakeup.clear()
+        next_due = await in_db(db.get_next_reminder_due)
+        if next_due:
+            # Новые напоминания всегда позже уже запланированных, будить раньше срока незачем
+            await asyncio.sleep(max((next_due - datetime.datetime.now()).total_seconds(), 0))
+        else:
+            await reminder_wakeup.wait()
+
+
+async def bitrix_sync_coro():
+    print("Bitrix sync is running")
+    while True:
+        try:
+            await lead_cache.sync(cfg.BITRIX_SYNC_DAYS)
+        except Exception as e:
+            print(f"Bitrix sync failed: {e}")
+        await asyncio.sleep(cfg.BITRIX_SYNC_INTERVAL)
 
 
 if __name__ == '__main__':
@@ -3,6 +3,72 @@ TOKEN = ""
 
 # Токен bitrix24
 BITRIX_URL = ""
+# Ограничения запросов к Bitrix24: запросов в секунду и одновременных запросов
+BITRIX_RATE_LIMIT = 2
+BITRIX_CONCURRENCY = 2
+# Сколько секунд локальные данные о лидах считаются актуальными
+BITRIX_CACHE_TTL = 5 * 60
+# Фоновая синхронизация лидов: период в секундах (0 - отключена) и за сколько дней
+BITRIX_SYNC_INTERVAL = 4 * 60
+BITRIX_SYNC_DAYS = 30
 
 # Список администраторов
 admins = ["bobak00"]
+
+# Рассылка опросов: число параллельных отправок и лимиты Telegram (сообщений в секунду)
+BROADCAST_WORKERS = 8
+GLOBAL_RATE_LIMIT = 30
+CHAT_RATE_LIMIT = 1
+# Сколько получателей отмечается в БД одной транзакцией перед отправкой им опроса
+BROADCAST_CLAIM_CHUNK = 100
+
+# Напоминания неответившим: интервал в секундах и сколько раз напомнить
+REMINDER_INTERVAL = 30 * 60
+REMINDER_COUNT = 2
+
+# Размер пула HTTP-соединений к Telegram API
+HTTP_POOL_SIZE = 100
+
+# Webhook: если WEBHOOK_URL пуст, бот работает через long polling
+WEBHOOK_URL = ""
+WEBHOOK_SECRET = ""
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_WORKERS = 8
+WEBHOOK_QUEUE_SIZE = 1000
+
+# Ожидающие ответа inline-кнопки: сколько хранить и сколько секунд они действительны
+CALLBACK_REGISTRY_SIZE = 1000
+CALLBACK_TTL = 24 * 60 * 60
+
+# Где хранить состояния многошаговых диалогов: "memory", "sqlite" или "redis"
+STATE_STORAGE = "sqlite"
+REDIS_URL = "redis://localhost:6379/0"
+
+# Число процессов-обработчиков обновлений (1 - все в одном процессе). Для нескольких процессов нужен STATE_STORAGE
+# "sqlite" или "redis". Рассылки ведет один процесс - тот, что держит аренду планировщика в БД
+WORKERS = 1
+WORKER_QUEUE_SIZE = 1000
+SCHEDULER_LEASE_TTL = 30
+# Как часто планировщик проверяет новые опросы, созданные в других процессах
+SCHEDULER_POLL_INTERVAL = 10
+
+# SQLite: соединений в пуле, сколько секунд ждать освободившуюся блокировку БД,
+# сколько подготовленных запросов хранить на каждом соединении
+DB_POOL_SIZE = 10
+DB_BUSY_TIMEOUT = 30
+DB_STATEMENT_CACHE = 256
+# Обработчики и планировщик обращаются к БД из пула потоков, но мелкие записи состояний диалогов и колбэков
+# идут прямо из цикла событий. Столько секунд они ждут блокировку, прежде чем упасть с "database is locked",
+# чтобы запись другого процесса не останавливала весь бот
+DB_LOOP_BUSY_TIMEOUT = 1
+
+# Ответы пользователей сохраняются пачками: сколько секунд копить пачку и ее максимальный размер
+WRITE_BEHIND_DELAY = 0.005
+WRITE_BEHIND_BATCH = 500
+
+# Счетчики ответов: через сколько секунд перечитывать их из БД (записи других процессов),
+# как часто обновлять сообщение /live и сколько секунд его обновлять
+TALLY_CACHE_TTL = 5
+LIVE_RESULTS_INTERVAL = 3
+LIVE_RESULTS_TTL = 60 * 60
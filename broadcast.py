@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from telebot.asyncio_helper import ApiTelegramException
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Сколько секунд ждать до появления токена (0 - токен уже взят)"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while wait := self.delay():
+            await asyncio.sleep(wait)
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """Глобальный лимит Telegram плюс отдельный лимит на каждый чат"""
+    max_chats = 10000
+
+    def __init__(self, global_rate, chat_rate):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.blocked_until = 0
+
+    def _chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) >= self.max_chats:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle()}
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return self.chat_buckets[chat_id]
+
+    async def acquire(self, chat_id):
+        await self._chat_bucket(chat_id).acquire()
+        while (wait := self.blocked_until - time.monotonic()) > 0:
+            await asyncio.sleep(wait)
+        await self.global_bucket.acquire()
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    def __init__(self, limiter, workers=8, claim_chunk=100):
+        self.limiter = limiter
+        self.workers = workers
+        self.claim_chunk = claim_chunk
+
+    async def run(self, recipients, send, claim=None):
+        """Рассылает send(chat_id) по recipients пулом из self.workers корутин.
+
+        claim(chat_ids) вызывается в пуле потоков перед отправкой каждой пачки из self.claim_chunk получателей,
+        должен атомарно отметить доставку в БД и вернуть тех, кого еще не отмечали. Так после
+        падения процесса посреди рассылки никто не получит сообщение дважды (но не получит его
+        и остаток отмеченной пачки)."""
+        recipients = list(recipients)
+        stats = {"sent": 0, "failed": 0, "skipped": 0}
+        started = time.monotonic()
+        chunk_size = self.claim_chunk if claim else max(len(recipients), 1)
+        for i in range(0, len(recipients), chunk_size):
+            chunk = recipients[i:i + chunk_size]
+            if claim:
+                claimed = await asyncio.get_running_loop().run_in_executor(None, claim, chunk)
+                stats["skipped"] += len(chunk) - len(claimed)
+                chunk = claimed
+            queue = asyncio.Queue()
+            for chat_id in chunk:
+                queue.put_nowait(chat_id)
+            await asyncio.gather(*[self._worker(queue, send, stats) for _ in range(min(self.workers, queue.qsize()))])
+        elapsed = time.monotonic() - started
+        stats["elapsed"] = elapsed
+        stats["rate"] = stats["sent"] / elapsed if elapsed else 0.0
+        print(f"Broadcast finished: {stats['sent']} sent, {stats['failed']} failed, "
+              f"{stats['skipped']} skipped in {elapsed:.1f}s ({stats['rate']:.1f} msg/s)")
+        return stats
+
+    async def _worker(self, queue, send, stats):
+        while not queue.empty():
+            chat_id = queue.get_nowait()
+            await self.limiter.acquire(chat_id)
+            while True:
+                try:
+                    await send(chat_id)
+                except ApiTelegramException as e:
+                    if e.error_code == 429:
+                        retry_after = e.result_json.get("parameters", {}).get("retry_after", 1)
+                        print(f"Flood limit hit, pausing for {retry_after}s")
+                        self.limiter.pause(retry_after)
+                        await self.limiter.acquire(chat_id)
+                        continue
+                    print(f"Failed to send to {chat_id}: {e}")
+                    stats["failed"] += 1
+                except Exception as e:
+                    print(f"Failed to send to {chat_id}: {e}")
+                    stats["failed"] += 1
+                else:
+                    stats["sent"] += 1
+                break
@@ -1,76 +1,105 @@
 import datetime
-import copy
 import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple
 
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, desc
+from sqlalchemy import Column, Integer, String, Date, DateTime, Boolean, ForeignKey, Index, and_, case, desc, event, \
+    exists, bindparam, delete, func, or_, select, text, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import QueuePool
 
 import bot_config as cfg
 
 Base = declarative_base()
 
+SCHEMA_VERSION = 8
+
+
+class UserRole(Base):
+    __tablename__ = "user_roles"
+    tg_user_id = Column(Integer, ForeignKey("users.tg_user_id"), primary_key=True)
+    role_name = Column(String, ForeignKey("roles.name"), primary_key=True, index=True)
+
+    def __init__(self, role_name=None, tg_user_id=None):
+        self.role_name = role_name
+        self.tg_user_id = tg_user_id
+
+
+class QuestionRole(Base):
+    __tablename__ = "question_roles"
+    question_id = Column(Integer, ForeignKey("questions.id"), primary_key=True)
+    role_name = Column(String, primary_key=True, index=True)
+
+    def __init__(self, role_name):
+        self.role_name = role_name
+
+
+class QuestionUser(Base):
+    __tablename__ = "question_users"
+    question_id = Column(Integer, ForeignKey("questions.id"), primary_key=True)
+    tg_user_id = Column(Integer, primary_key=True, index=True)
+
+    def __init__(self, tg_user_id):
+        self.tg_user_id = tg_user_id
+
+
+class Delivery(Base):
+    """Доставка опроса пользователю. Строка появляется, когда рассылка отмечает получателя (mark_sent), а delivered -
+    когда сообщение с опросом отправлено; с этого момента и пока не выставлен answered опрос ждет ответа"""
+    __tablename__ = "question_deliveries"
+    question_id = Column(Integer, ForeignKey("questions.id"), primary_key=True)
+    tg_user_id = Column(Integer, primary_key=True, index=True)
+    delivered = Column(DateTime)
+    # Сообщение с опросом (по нему определяется, на какой опрос отвечают реплаем) и когда под сообщениями
+    # последний раз показывалась клавиатура этого опроса
+    message_id = Column(Integer)
+    presented = Column(DateTime)
+    answered = Column(Boolean, nullable=False, default=False, server_default=sqlalchemy.false())
+
+    __table_args__ = (Index("ix_question_deliveries_tg_user_id_answered", "tg_user_id", "answered"),)
+
+    def __init__(self, question_id, tg_user_id):
+        self.question_id = question_id
+        self.tg_user_id = tg_user_id
+
 
 class Role(Base):
     __tablename__ = "roles"
     name = Column(String, primary_key=True)
-    users_json = Column(String)  # json-dumped list
+    members = relationship(UserRole, cascade="all, delete-orphan", lazy="selectin")
 
     def __init__(self, name):
         self.name = name
-        self.users_json = json.dumps([])
-
-    def add_user(self, tg_user_id):
-        users = json.loads(self.users_json)
-        users.append(tg_user_id)
-        self.users_json = json.dumps(list(set(users)))
-
-    def remove_user(self, tg_user_id):
-        users = json.loads(self.users_json)
-        users.pop(users.index(tg_user_id))
-        self.users_json = json.dumps(list(set(users)))
 
     def get_users(self):
-        return json.loads(self.users_json)
+        return [member.tg_user_id for member in self.members]
 
 
 class User(Base):
     __tablename__ = "users"
     tg_user_id = Column(Integer, primary_key=True)
-    username = Column(String)
+    username = Column(String, index=True)
     user_str = Column(String)
-    roles_json = Column(String)
     admin = Column(Boolean)
-    answered_last_question = Column(Boolean)
-    last_question_notifications = Column(Integer)
     bx_id = Column(Integer)
+    role_links = relationship(UserRole, cascade="all, delete-orphan", lazy="selectin")
+    roles = association_proxy("role_links", "role_name")
 
     def __init__(self, tg_user_id, username=None, user_str=None):
         self.tg_user_id = tg_user_id
         self.username = username
         self.user_str = user_str
-        self.roles_json = json.dumps([])
         self.admin = username in cfg.admins
-        self.answered_last_question = True
-        self.last_question_notifications = 0
-
-    def add_role(self, role):
-        roles = json.loads(self.roles_json)
-        roles.append(role)
-        self.roles_json = json.dumps(list(set(roles)))
-
-    def remove_role(self, role):
-        roles = json.loads(self.roles_json)
-        try:
-            roles.pop(roles.index(role))
-        except ValueError:
-            pass
-        else:
-            self.roles_json = json.dumps(roles)
 
     def get_roles(self):
-        return json.loads(self.roles_json)
+        return list(self.roles)
 
 
 class Question(Base):
@@ -78,211 +107,939 @@ class Question(Base):
     id = Column(Integer, primary_key=True)
     text = Column(String)
     for_all = Column(Boolean)
-    roles_for_json = Column(String)
-    users_for_json = Column(String)
     answer_options_json = Column(String)
     optional = Column(Boolean)
     send_datetime = Column(DateTime)
     sent = Column(Boolean)
-    sent_to_json = Column(String)
+    # Увеличивается при каждом изменении текста или вариантов ответа, по ней сбрасывается кэш отрисовки
+    version = Column(Integer, nullable=False, default=1)
+    role_targets = relationship(QuestionRole, cascade="all, delete-orphan", lazy="selectin")
+    user_targets = relationship(QuestionUser, cascade="all, delete-orphan", lazy="selectin")
+    roles_for = association_proxy("role_targets", "role_name")
+    users_for = association_proxy("user_targets", "tg_user_id")
+
+    __table_args__ = (Index("ix_questions_sent_send_datetime", "sent", "send_datetime"),)
 
     def __init__(self, text: str = '', for_all: bool = False, roles_for: list = [], users_for: list = [],
                  answer_options: list = [], optional: bool = [],
                  send_datetime: datetime.datetime = None):
         self.text = text
         self.for_all = for_all
-        self.roles_for_json = json.dumps(roles_for)
-        self.users_for_json = json.dumps(users_for)
+        self.roles_for = roles_for
+        self.users_for = users_for
         self.answer_options_json = json.dumps(answer_options)
         self.optional = optional
         self.send_datetime = send_datetime
         self.sent = False
-        self.sent_to_json = json.dumps([])
+        self.version = 1
 
     def get_roles_for(self):
-        return json.loads(self.roles_for_json)
+        return list(self.roles_for)
 
     def get_users_for(self):
-        return json.loads(self.users_for_json)
+        return list(self.users_for)
 
     def get_answer_options(self):
         return json.loads(self.answer_options_json)
 
-    def get_sent_to(self):
-        return json.loads(self.sent_to_json)
-
 
 class Answer(Base):
     __tablename__ = "answers"
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer)
-    question_id = Column(Integer)
+    question_id = Column(Integer, index=True)
+    # Номер выбранного варианта ответа; text заполняется только для развернутых ответов
+    option_id = Column(Integer)
     text = Column(String)
 
-    def __init__(self, user_id, question_id, text):
+    # Один ответ пользователя на опрос; индекс также обслуживает выборки по user_id
+    __table_args__ = (Index("ux_answers_user_id_question_id", "user_id", "question_id", unique=True),)
+
+    def __init__(self, user_id, question_id, text=None, option_id=None):
         self.user_id = user_id
         self.question_id = question_id
+        self.option_id = option_id
         self.text = text
 
 
+class AnswerTally(Base):
+    """Число ответов-вариантов на опрос: по всем пользователям (role_name = "") и по каждой роли"""
+    __tablename__ = "answer_tallies"
+    question_id = Column(Integer, primary_key=True)
+    role_name = Column(String, primary_key=True)
+    option_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class Reminder(Base):
+    __tablename__ = "reminders"
+    tg_user_id = Column(Integer, primary_key=True)
+    question_id = Column(Integer, primary_key=True)
+    due = Column(DateTime, index=True)
+    notifications = Column(Integer)
+
+    def __init__(self, tg_user_id, question_id, due):
+        self.tg_user_id = tg_user_id
+        self.question_id = question_id
+        self.due = due
+        self.notifications = 0
+
+
+class Lead(Base):
+    """Локальная копия лида Bitrix24"""
+    __tablename__ = "leads"
+    id = Column(Integer, primary_key=True)
+    created_by_id = Column(Integer)
+    date_create = Column(DateTime)
+    date_modify = Column(DateTime)
+    status_id = Column(String)
+    date_closed = Column(DateTime)
+
+    __table_args__ = (Index("ix_leads_created_by_id_date_create", "created_by_id", "date_create"),)
+
+
+class LeadSync(Base):
+    """До какой даты создания лиды пользователя загружены и когда они последний раз обновлялись"""
+    __tablename__ = "lead_syncs"
+    bx_id = Column(Integer, primary_key=True)
+    covered_since = Column(DateTime)
+    synced_at = Column(DateTime)
+
+
+class LeadDaily(Base):
+    """Дневные итоги по лидам пользователя Bitrix24 (по дате создания лида)"""
+    __tablename__ = "lead_daily"
+    bx_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    leads = Column(Integer)
+    converted = Column(Integer)
+    in_work = Column(Integer)
+
+
+def _bx_datetime(value):
+    """Время портала со смещением -> локальное время сервера, в котором хранятся все даты БД"""
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value).astimezone().replace(tzinfo=None)
+
+
+class PendingCallback(Base):
+    __tablename__ = "callbacks"
+    chat_id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, primary_key=True)
+    func_name = Column(String)
+    args_json = Column(String)
+    created = Column(DateTime, index=True)
+
+
+class ConversationState(Base):
+    __tablename__ = "conversation_states"
+    chat_id = Column(Integer, primary_key=True)
+    state = Column(String)
+    data_json = Column(String)
+    updated = Column(DateTime)
+
+
+class Lease(Base):
+    __tablename__ = "leases"
+    name = Column(String, primary_key=True)
+    owner = Column(String)
+    expires = Column(DateTime)
+
+
+class RoleRecord(NamedTuple):
+    name: str
+    users: tuple
+
+    def get_users(self):
+        return list(self.users)
+
+
+class UserRecord(NamedTuple):
+    tg_user_id: int
+    username: str
+    user_str: str
+    admin: bool
+    bx_id: int
+    roles: tuple
+
+    def get_roles(self):
+        return list(self.roles)
+
+
+class QuestionRecord(NamedTuple):
+    id: int
+    text: str
+    for_all: bool
+    answer_options: tuple
+    optional: bool
+    send_datetime: datetime.datetime
+    sent: bool
+    roles_for: tuple
+    users_for: tuple
+    version: int = 1
+
+    def get_roles_for(self):
+        return list(self.roles_for)
+
+    def get_users_for(self):
+        return list(self.users_for)
+
+    def get_answer_options(self):
+        return list(self.answer_options)
+
+
+class PendingQuestion(NamedTuple):
+    question_id: int
+    version: int
+    message_id: int
+    presented: datetime.datetime
+
+
+class AnswerRecord(NamedTuple):
+    id: int
+    user_id: int
+    question_id: int
+    text: str
+    option_id: int = None
+
+
+def _answer_text(options, option_id, text_):
+    return options[option_id] if option_id is not None else text_
+
+
+USER_COLUMNS = (User.tg_user_id, User.username, User.user_str, User.admin, User.bx_id)
+QUESTION_COLUMNS = (Question.id, Question.text, Question.for_all, Question.answer_options_json, Question.optional,
+                    Question.send_datetime, Question.sent, Question.version)
+ANSWER_COLUMNS = (Answer.id, Answer.user_id, Answer.question_id, Answer.option_id, Answer.text)
+
+
+def _group(pairs):
+    groups = {}
+    for key, value in pairs:
+        groups.setdefault(key, []).append(value)
+    return groups
+
+
+def _column_names(conn, table):
+    return [row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))]
+
+
+def _migrate_json_columns(conn):
+    """Версия 1: списки в json-колонках переносятся в таблицы связей"""
+    if "roles_json" in _column_names(conn, "users"):
+        for tg_user_id, roles_json in conn.execute(text("SELECT tg_user_id, roles_json FROM users")):
+            for role in json.loads(roles_json or "[]"):
+                conn.execute(text("INSERT OR IGNORE INTO roles (name) VALUES (:role)"), {"role": role})
+                conn.execute(text("INSERT OR IGNORE INTO user_roles (tg_user_id, role_name) VALUES (:uid, :role)"),
+                             {"uid": tg_user_id, "role": role})
+    if "users_json" in _column_names(conn, "roles"):
+        for name, users_json in conn.execute(text("SELECT name, users_json FROM roles")):
+            for tg_user_id in json.loads(users_json or "[]"):
+                conn.execute(text("INSERT OR IGNORE INTO user_roles (tg_user_id, role_name) VALUES (:uid, :role)"),
+                             {"uid": tg_user_id, "role": name})
+    if "roles_for_json" in _column_names(conn, "questions"):
+        rows = conn.execute(text("SELECT id, roles_for_json, users_for_json, sent_to_json FROM questions")).all()
+        for question_id, roles_for_json, users_for_json, sent_to_json in rows:
+            for role in json.loads(roles_for_json or "[]"):
+                conn.execute(text("INSERT OR IGNORE INTO question_roles (question_id, role_name) VALUES (:qid, :role)"),
+                             {"qid": question_id, "role": role})
+            for tg_user_id in json.loads(users_for_json or "[]"):
+                conn.execute(text("INSERT OR IGNORE INTO question_users (question_id, tg_user_id) VALUES (:qid, :uid)"),
+                             {"qid": question_id, "uid": tg_user_id})
+            for tg_user_id in json.loads(sent_to_json or "[]"):
+                conn.execute(text("INSERT OR IGNORE INTO question_deliveries (question_id, tg_user_id) "
+                                  "VALUES (:qid, :uid)"), {"qid": question_id, "uid": tg_user_id})
+
+
+def _build_lead_daily(conn):
+    """Версия 2: дневные итоги по уже загруженным лидам"""
+    conn.execute(text("INSERT OR REPLACE INTO lead_daily (bx_id, day, leads, converted, in_work) "
+                      "SELECT created_by_id, date(date_create), COUNT(id), SUM(status_id = 'CONVERTED'), "
+                      "SUM(date_closed IS NULL) FROM leads GROUP BY created_by_id, date(date_create)"))
+
+
+def _add_indexes(conn):
+    """Версия 3: индексы для частых запросов; повторные ответы на опрос удаляются, остается первый"""
+    conn.execute(text("DELETE FROM answers WHERE id NOT IN "
+                      "(SELECT MIN(id) FROM answers GROUP BY user_id, question_id)"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_answers_user_id_question_id "
+                      "ON answers (user_id, question_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_answers_question_id ON answers (question_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_username ON users (username)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_questions_sent_send_datetime ON questions (sent, send_datetime)"))
+
+
+def _add_question_version(conn):
+    """Версия 4: версия опроса для кэша отрисовки"""
+    if "version" not in _column_names(conn, "questions"):
+        conn.execute(text("ALTER TABLE questions ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+def _add_answer_option_id(conn):
+    """Версия 5: ответы-варианты хранятся номером варианта вместо текста"""
+    if "option_id" not in _column_names(conn, "answers"):
+        conn.execute(text("ALTER TABLE answers ADD COLUMN option_id INTEGER"))
+    for question_id, options_json in conn.execute(text("SELECT id, answer_options_json FROM questions")).all():
+        for option_id, option in enumerate(json.loads(options_json or "[]")):
+            conn.execute(text("UPDATE answers SET option_id = :option_id, text = NULL "
+                              "WHERE question_id = :qid AND option_id IS NULL AND text = :option"),
+                         {"option_id": option_id, "qid": question_id, "option": option})
+
+
+def _build_answer_tallies(conn):
+    """Версия 6: счетчики ответов по уже сохраненным ответам"""
+    conn.execute(text("INSERT OR REPLACE INTO answer_tallies (question_id, role_name, option_id, count) "
+                      "SELECT question_id, '', option_id, COUNT(id) FROM answers WHERE option_id IS NOT NULL "
+                      "GROUP BY question_id, option_id"))
+    conn.execute(text("INSERT OR REPLACE INTO answer_tallies (question_id, role_name, option_id, count) "
+                      "SELECT answers.question_id, user_roles.role_name, answers.option_id, COUNT(answers.id) "
+                      "FROM answers JOIN user_roles ON user_roles.tg_user_id = answers.user_id "
+                      "WHERE answers.option_id IS NOT NULL "
+                      "GROUP BY answers.question_id, user_roles.role_name, answers.option_id"))
+
+
+def _add_pending_questions(conn):
+    """Версия 7: очередь неотвеченных опросов в доставках. Ожидающим ответа остается только опрос,
+    ответ на который ждал шаг handle_answer старой версии бота, остальные доставки считаются закрытыми"""
+    columns = _column_names(conn, "question_deliveries")
+    for column, type_ in [("delivered", "DATETIME"), ("message_id", "INTEGER"), ("presented", "DATETIME"),
+                          ("answered", "BOOLEAN NOT NULL DEFAULT 0")]:
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE question_deliveries ADD COLUMN {column} {type_}"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_question_deliveries_tg_user_id_answered "
+                      "ON question_deliveries (tg_user_id, answered)"))
+    waiting = [(chat_id, json.loads(data_json)[0]) for chat_id, data_json in
+               conn.execute(text("SELECT chat_id, data_json FROM conversation_states WHERE state = 'handle_answer'"))]
+    conn.execute(text("UPDATE question_deliveries SET answered = 1"))
+    for tg_user_id, question_id in waiting:
+        conn.execute(text("UPDATE question_deliveries SET answered = 0, delivered = :now "
+                          "WHERE tg_user_id = :uid AND question_id = :qid "
+                          "AND NOT EXISTS (SELECT 1 FROM answers WHERE user_id = :uid AND question_id = :qid)"),
+                     {"uid": tg_user_id, "qid": question_id, "now": datetime.datetime.now()})
+    conn.execute(text("DELETE FROM conversation_states WHERE state = 'handle_answer'"))
+
+
+def _reset_leads(conn):
+    """Версия 8: даты лидов хранились во времени портала, а не сервера. Лиды удаляются и при следующей
+    синхронизации загружаются заново"""
+    for table in ("leads", "lead_daily", "lead_syncs"):
+        conn.execute(text(f"DELETE FROM {table}"))
+
+
+MIGRATIONS = {1: _migrate_json_columns, 2: _build_lead_daily, 3: _add_indexes, 4: _add_question_version,
+              5: _add_answer_option_id, 6: _build_answer_tallies, 7: _add_pending_questions, 8: _reset_leads}
+
+
+def migrate(engine):
+    with engine.begin() as conn:
+        version = conn.execute(text("PRAGMA user_version")).scalar()
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            print(f"Migrating database to version {target}")
+            MIGRATIONS[target](conn)
+        if version < SCHEMA_VERSION:
+            conn.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+
+
+def _configure_connection(dbapi_connection, connection_record):
+    # WAL: читатели не блокируют писателя; NORMAL достаточно для WAL и не делает fsync на каждый commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(cfg.DB_BUSY_TIMEOUT * 1000)}")
+    cursor.close()
+
+
 class Handler:
     database_path = "database.db"
 
     def __init__(self, database_path=None, base=Base):
         if database_path:
             self.database_path = database_path
-        engine = sqlalchemy.create_engine(f"sqlite:///{self.database_path}" + '?check_same_thread=False')
+        engine = sqlalchemy.create_engine(
+            f"sqlite:///{self.database_path}", poolclass=QueuePool,
+            pool_size=cfg.DB_POOL_SIZE, max_overflow=cfg.DB_POOL_SIZE, pool_timeout=cfg.DB_BUSY_TIMEOUT,
+            connect_args={"check_same_thread": False, "timeout": cfg.DB_BUSY_TIMEOUT,
+                          "cached_statements": cfg.DB_STATEMENT_CACHE})
+        event.listen(engine, "connect", _configure_connection)
+        event.listen(engine, "checkout", self._set_busy_timeout)
+        # {id потока: секунды} - потоки, которым нельзя долго ждать блокировку БД (цикл событий бота)
+        self.busy_timeouts = {}
         base.metadata.create_all(engine)
+        migrate(engine)
+        self.engine = engine
         self.session = sessionmaker(bind=engine, expire_on_commit=False)
+        # Зеркало answer_tallies: {(id опроса, роль или ""): (время загрузки, {номер варианта: число ответов})}.
+        # Ответы этого процесса учитываются сразу, записи других процессов - после tally_ttl секунд
+        self.tallies = {}
+        self.tally_ttl = cfg.TALLY_CACHE_TTL
 
-    def create_role(self, name):
-        if not name in [role.name for role in self.get_roles()]:
-            session = self.session()
-            role = Role(name)
-            session.add(role)
+    def set_thread_busy_timeout(self, seconds):
+        """Сколько соединения, взятые текущим потоком, ждут блокировку БД вместо DB_BUSY_TIMEOUT"""
+        self.busy_timeouts[threading.get_ident()] = seconds
+
+    def _set_busy_timeout(self, dbapi_connection, connection_record, connection_proxy):
+        timeout = self.busy_timeouts.get(threading.get_ident(), cfg.DB_BUSY_TIMEOUT)
+        if connection_record.info.get("busy_timeout", cfg.DB_BUSY_TIMEOUT) != timeout:
+            dbapi_connection.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+            connection_record.info["busy_timeout"] = timeout
+
+    @contextmanager
+    def session_scope(self):
+        """Сессия, которая фиксируется при выходе из блока, откатывается при ошибке и всегда закрывается"""
+        session = self.session()
+        try:
+            yield session
             session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _users(self, session, *criteria):
+        rows = session.query(*USER_COLUMNS).filter(*criteria).order_by(User.tg_user_id).all()
+        roles = _group(session.query(UserRole.tg_user_id, UserRole.role_name).
+                       join(User, User.tg_user_id == UserRole.tg_user_id).filter(*criteria))
+        return [UserRecord(*row, roles=tuple(roles.get(row[0], ()))) for row in rows]
+
+    def _roles(self, session, *criteria):
+        names = [name for name, in session.query(Role.name).filter(*criteria)]
+        users = _group((role_name, tg_user_id) for tg_user_id, role_name in
+                       session.query(UserRole.tg_user_id, UserRole.role_name).
+                       join(Role, Role.name == UserRole.role_name).filter(*criteria))
+        return [RoleRecord(name, tuple(users.get(name, ()))) for name in names]
+
+    def _questions(self, session, *criteria, order_by=Question.id):
+        rows = session.query(*QUESTION_COLUMNS).filter(*criteria).order_by(order_by).all()
+        roles = _group(session.query(QuestionRole.question_id, QuestionRole.role_name).
+                       join(Question, Question.id == QuestionRole.question_id).filter(*criteria))
+        users = _group(session.query(QuestionUser.question_id, QuestionUser.tg_user_id).
+                       join(Question, Question.id == QuestionUser.question_id).filter(*criteria))
+        return [QuestionRecord(id_, text_, for_all, tuple(json.loads(options_json)), optional, send_datetime, sent,
+                               tuple(roles.get(id_, ())), tuple(users.get(id_, ())), version)
+                for id_, text_, for_all, options_json, optional, send_datetime, sent, version in rows]
+
+    def create_role(self, name):
+        with self.session_scope() as session:
+            self._create_role(session, name)
+
+    def _create_role(self, session, name):
+        if not session.query(Role.name).filter(Role.name == name).first():
+            session.add(Role(name))
 
     def remove_role(self, name):
-        session = self.session()
-        role = session.query(Role).filter(Role.name == name).one()
-        users = role.get_users()
-        for user in users:
-            user = session.query(User).filter(User.tg_user_id == user).one()
-            user.remove_role(name)
-        session.delete(role)
-        session.commit()
+        with self.session_scope() as session:
+            role = session.query(Role).filter(Role.name == name).one()
+            session.delete(role)
+            session.query(AnswerTally).filter(AnswerTally.role_name == name).delete(synchronize_session=False)
+        for key in [key for key in self.tallies if key[1] == name]:
+            del self.tallies[key]
 
     def get_role(self, name):
-        session = self.session()
-        role = copy.deepcopy(session.query(Role).filter(Role.name == name).one())
-        session.close()
-        return role
+        with self.session_scope() as session:
+            roles = self._roles(session, Role.name == name)
+        if not roles:
+            raise NoResultFound(f"No role {name}")
+        return roles[0]
 
     def create_user(self, tg_user_id, username=None, user_str=None):
-        session = self.session()
-        if session.query(User).filter(User.tg_user_id == tg_user_id).first():
-            return
-        user = User(tg_user_id, username, user_str)
-        session.add(user)
-        session.commit()
+        with self.session_scope() as session:
+            if session.query(User).filter(User.tg_user_id == tg_user_id).first():
+                return
+            user = User(tg_user_id, username, user_str)
+            session.add(user)
 
     def remove_user(self, tg_user_id):
-        session = self.session()
-        user = session.query(User).filter(User.tg_user_id == tg_user_id).one()
-        roles = user.get_roles()
-        for role in roles:
-            self.get_role(role).remove_user(tg_user_id)
-        session.delete(user)
-        session.commit()
+        with self.session_scope() as session:
+            user = session.query(User).filter(User.tg_user_id == tg_user_id).one()
+            deltas = self._user_tallies(session, tg_user_id, list(user.roles), -1)
+            session.delete(user)
+        self._mirror_tallies(deltas)
 
     def get_user(self, tg_user_id=None, username=None):
-        session = self.session()
-        if tg_user_id:
-            user = copy.deepcopy(session.query(User).filter(User.tg_user_id == tg_user_id).one())
-        elif username:
-            user = copy.deepcopy(session.query(User).filter(User.username == username).one())
-        else:
-            raise AttributeError("tg_user_id or username were not given")
-        session.close()
-        return user
+        with self.session_scope() as session:
+            if tg_user_id:
+                users = self._users(session, User.tg_user_id == tg_user_id)
+            elif username:
+                users = self._users(session, User.username == username)
+            else:
+                raise AttributeError("tg_user_id or username were not given")
+        if not users:
+            raise NoResultFound(f"No user {tg_user_id or username}")
+        if len(users) > 1:
+            raise MultipleResultsFound(f"Multiple users {username}")
+        return users[0]
 
     def get_roles(self):
-        session = self.session()
-        roles = copy.deepcopy(session.query(Role).all())
-        session.close()
-        return roles
+        with self.session_scope() as session:
+            return self._roles(session)
 
-    def get_users(self):
-        session = self.session()
-        users = copy.deepcopy(session.query(User).all())
-        session.close()
-        return users
+    def get_users(self, after=None, limit=None):
+        """Пользователи по возрастанию tg_user_id, при постраничной выборке - limit штук после after"""
+        with self.session_scope() as session:
+            if after is None and limit is None:
+                return self._users(session)
+            query = session.query(User.tg_user_id).order_by(User.tg_user_id)
+            if after is not None:
+                query = query.filter(User.tg_user_id > after)
+            return self._users(session, User.tg_user_id.in_([id_ for id_, in query.limit(limit)]))
+
+    def get_role_members(self, after=None, limit=None):
+        """[(роль, tg_user_id, user_str)] по возрастанию (роль, tg_user_id), after - такая же пара.
+        Роль без участников дает одну строку с tg_user_id и user_str None"""
+        with self.session_scope() as session:
+            query = session.query(Role.name, UserRole.tg_user_id, User.user_str). \
+                outerjoin(UserRole, UserRole.role_name == Role.name). \
+                outerjoin(User, User.tg_user_id == UserRole.tg_user_id).order_by(Role.name, UserRole.tg_user_id)
+            if after is not None:
+                query = query.filter(tuple_(Role.name, UserRole.tg_user_id) > tuple(after))
+            return query.limit(limit).all()
 
     def mkrole(self, username, role):
-        session = self.session()
-        user = session.query(User).filter(User.username == username).one()
-        user.add_role(role)
-        self.create_role(role)
-        role = session.query(Role).filter(Role.name == role).one()
-        role.add_user(user.tg_user_id)
-        session.commit()
+        with self.session_scope() as session:
+            user = session.query(User).filter(User.username == username).one()
+            self._create_role(session, role)
+            deltas = {}
+            if role not in user.roles:
+                user.roles.append(role)
+                deltas = self._user_tallies(session, user.tg_user_id, [role], 1)
+        self._mirror_tallies(deltas)
 
     def rmrole(self, username, role):
-        session = self.session()
-        user = session.query(User).filter(User.username == username).one()
-        user.remove_role(role)
-        role = session.query(Role).filter(Role.name == role).one()
-        role.remove_user(user.tg_user_id)
-        session.commit()
+        with self.session_scope() as session:
+            user = session.query(User).filter(User.username == username).one()
+            session.query(Role).filter(Role.name == role).one()
+            deltas = {}
+            if role in user.roles:
+                user.roles.remove(role)
+                deltas = self._user_tallies(session, user.tg_user_id, [role], -1)
+        self._mirror_tallies(deltas)
 
     def create_question(self, question_obj):
-        session = self.session()
-        session.add(question_obj)
-        session.commit()
+        with self.session_scope() as session:
+            session.add(question_obj)
 
-    def get_outdated_question(self):
-        session = self.session()
-        question = session.query(Question).filter(Question.sent == False). \
-            filter(Question.send_datetime <= datetime.datetime.now()).first()
-        if not question:
-            return None
-        session.close()
-        return copy.deepcopy(question)
-
-    def create_answer(self, tg_user_id, question_id, text):
-        answer = Answer(tg_user_id, question_id, text)
-        session = self.session()
-        session.add(answer)
-        session.commit()
+    def get_outdated_questions(self):
+        with self.session_scope() as session:
+            return self._questions(session, Question.sent == False, Question.send_datetime <= datetime.datetime.now(),
+                                   order_by=Question.send_datetime)
+
+    def get_next_send_datetime(self):
+        """Срок ближайшего неразосланного опроса; в прошлом, если опрос наступил во время предыдущей рассылки"""
+        with self.session_scope() as session:
+            return session.query(func.min(Question.send_datetime)).filter(Question.sent == False).scalar()
+
+    def create_answer(self, tg_user_id, question_id, text=None, option_id=None):
+        """False, если пользователь уже отвечал на этот опрос (ответ не сохраняется)"""
+        with self.session_scope() as session:
+            statement = sqlite_insert(Answer).values(user_id=tg_user_id, question_id=question_id, option_id=option_id,
+                                                     text=text)
+            result = session.execute(statement.on_conflict_do_nothing(index_elements=[Answer.user_id,
+                                                                                      Answer.question_id]))
+            created = result.rowcount > 0
+            deltas = self._add_tallies(session, [(tg_user_id, question_id, option_id)]) if created else {}
+        self._mirror_tallies(deltas)
+        return created
+
+    def save_answers(self, answers):
+        """Сохраняет пачку ответов [(tg_user_id, question_id, номер варианта, текст)] одной транзакцией: сами ответы
+        (повторные пропускаются), снятие опросов из очереди ожидающих ответа и отмену напоминаний о них"""
+        with self.session_scope() as session:
+            # UPDATE берет блокировку записи до чтения max(id), поэтому все ответы с большим id вставлены ниже
+            self._close_pending(session, [(tg_user_id, question_id) for tg_user_id, question_id, _, _ in answers])
+            last_id = session.query(func.max(Answer.id)).scalar() or 0
+            session.execute(sqlite_insert(Answer).on_conflict_do_nothing(index_elements=[Answer.user_id,
+                                                                                         Answer.question_id]),
+                            [{"user_id": tg_user_id, "question_id": question_id, "option_id": option_id, "text": text_}
+                             for tg_user_id, question_id, option_id, text_ in answers])
+            created = session.query(Answer.user_id, Answer.question_id, Answer.option_id). \
+                filter(Answer.id > last_id).all()
+            deltas = self._add_tallies(session, created)
+        self._mirror_tallies(deltas)
+
+    def _close_pending(self, session, pairs):
+        """Снимает опросы [(tg_user_id, id опроса)] с ожидания ответа и удаляет напоминания о них"""
+        params = [{"uid": tg_user_id, "qid": question_id} for tg_user_id, question_id in pairs]
+        session.execute(update(Delivery).where(Delivery.tg_user_id == bindparam("uid")).
+                        where(Delivery.question_id == bindparam("qid")).values(answered=True), params)
+        session.execute(delete(Reminder).where(Reminder.tg_user_id == bindparam("uid")).
+                        where(Reminder.question_id == bindparam("qid")), params)
+
+    def skip_question(self, tg_user_id, question_id):
+        with self.session_scope() as session:
+            self._close_pending(session, [(tg_user_id, question_id)])
+
+    def get_pending(self, tg_user_id):
+        """Опросы, ждущие ответа пользователя, в порядке доставки: [PendingQuestion]. Опрос, которого пользователь
+        еще не получил (получатель отмечен, но сообщение не отправлено), ответа не ждет"""
+        with self.session_scope() as session:
+            return [PendingQuestion(*row) for row in
+                    session.query(Delivery.question_id, Question.version, Delivery.message_id, Delivery.presented).
+                    join(Question, Question.id == Delivery.question_id).
+                    filter(Delivery.tg_user_id == tg_user_id, Delivery.answered == False,
+                           Delivery.delivered != None).
+                    order_by(Delivery.delivered, Delivery.question_id)]
+
+    def present_question(self, tg_user_id, question_id):
+        """Запоминает, что клавиатура опроса снова показана пользователю"""
+        with self.session_scope() as session:
+            session.query(Delivery).filter(Delivery.tg_user_id == tg_user_id, Delivery.question_id == question_id). \
+                update({Delivery.presented: datetime.datetime.now()}, synchronize_session=False)
+
+    def save_deliveries(self, deliveries):
+        """Сохраняет пачку отправленных опросов [(tg_user_id, id опроса, id сообщения, срок напоминания)]:
+        время доставки, с которого опрос ждет ответа, сообщение для маршрутизации ответов и напоминание"""
+        now = datetime.datetime.now()
+        with self.session_scope() as session:
+            session.execute(update(Delivery).where(Delivery.tg_user_id == bindparam("uid")).
+                            where(Delivery.question_id == bindparam("qid")).
+                            values(delivered=now, message_id=bindparam("message_id"), presented=now),
+                            [{"uid": tg_user_id, "qid": question_id, "message_id": message_id}
+                             for tg_user_id, question_id, message_id, _ in deliveries])
+            statement = sqlite_insert(Reminder)
+            session.execute(statement.on_conflict_do_update(index_elements=[Reminder.tg_user_id, Reminder.question_id],
+                                                            set_={"due": statement.excluded.due}),
+                            [{"tg_user_id": tg_user_id, "question_id": question_id, "due": due, "notifications": 0}
+                             for tg_user_id, question_id, _, due in deliveries])
+
+    def _add_tallies(self, session, answers, roles=None, sign=1):
+        """Прибавляет ответы [(tg_user_id, id опроса, номер варианта)] к счетчикам answer_tallies: к общему и к
+        ролям пользователя (или только к roles, тогда без общего); возвращает {(id опроса, роль, вариант): изменение}"""
+        answers = [answer for answer in answers if answer[2] is not None]
+        if roles is None:
+            user_roles = _group(session.query(UserRole.tg_user_id, UserRole.role_name).
+                                filter(UserRole.tg_user_id.in_({answer[0] for answer in answers})))
+        deltas = {}
+        for tg_user_id, question_id, option_id in answers:
+            for role in roles if roles is not None else [""] + user_roles.get(tg_user_id, []):
+                key = (question_id, role, option_id)
+                deltas[key] = deltas.get(key, 0) + sign
+        if deltas:
+            statement = sqlite_insert(AnswerTally)
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[AnswerTally.question_id, AnswerTally.role_name, AnswerTally.option_id],
+                set_={"count": AnswerTally.count + statement.excluded.count}),
+                [{"question_id": question_id, "role_name": role, "option_id": option_id, "count": delta}
+                 for (question_id, role, option_id), delta in deltas.items()])
+        return deltas
+
+    def _mirror_tallies(self, deltas):
+        """Переносит изменения счетчиков в зеркало после фиксации транзакции"""
+        for (question_id, role, option_id), delta in deltas.items():
+            if (question_id, role) in self.tallies:
+                counts = self.tallies[(question_id, role)][1]
+                counts[option_id] = counts.get(option_id, 0) + delta
+
+    def _user_tallies(self, session, tg_user_id, roles, sign):
+        """Учитывает или вычитает ответы пользователя в счетчиках ролей roles при изменении его ролей"""
+        answers = session.query(Answer.user_id, Answer.question_id, Answer.option_id). \
+            filter(Answer.user_id == tg_user_id).all()
+        return self._add_tallies(session, answers, roles, sign)
+
+    def get_tallies(self, question_id, role=None):
+        """{номер варианта: число ответов} на опрос по всем пользователям или по роли, без пересчета ответов"""
+        key = (question_id, role or "")
+        loaded, counts = self.tallies.get(key, (None, None))
+        if loaded is None or time.monotonic() - loaded > self.tally_ttl:
+            with self.session_scope() as session:
+                counts = dict(session.query(AnswerTally.option_id, AnswerTally.count).
+                              filter(AnswerTally.question_id == question_id, AnswerTally.role_name == key[1]))
+            self.tallies[key] = (time.monotonic(), counts)
+        return dict(counts)
 
     def get_questions(self):
-        session = self.session()
-        questions = copy.deepcopy(session.query(Question).order_by(desc(Question.send_datetime)).all())
-        session.close()
-        return questions
+        with self.session_scope() as session:
+            return self._questions(session, order_by=desc(Question.send_datetime))
+
+    def get_question_texts(self, before=None, limit=None):
+        """[(id, текст)] опросов от новых к старым, при постраничной выборке - limit штук с id меньше before"""
+        with self.session_scope() as session:
+            query = session.query(Question.id, Question.text).order_by(desc(Question.id))
+            if before is not None:
+                query = query.filter(Question.id < before)
+            return query.limit(limit).all()
 
     def get_question(self, question_id):
-        session = self.session()
-        question = copy.deepcopy(session.query(Question).filter(Question.id == question_id).one())
-        session.close()
-        return question
+        with self.session_scope() as session:
+            questions = self._questions(session, Question.id == question_id)
+        if not questions:
+            raise NoResultFound(f"No question {question_id}")
+        return questions[0]
 
     def get_answers(self, question_id=None, tg_user_id=None, role=None):
-        session = self.session()
-        if question_id:
-            if not role:
-                answers = copy.deepcopy(session.query(Answer).filter(Answer.question_id == question_id).all())
+        with self.session_scope() as session:
+            if question_id:
+                rows = self._answers_query(session, ANSWER_COLUMNS, question_id, role).order_by(Answer.id).all()
+            elif tg_user_id:
+                rows = session.query(*ANSWER_COLUMNS).filter(Answer.user_id == tg_user_id).all()
             else:
-                answers = copy.deepcopy(session.query(Answer).filter(Answer.question_id == question_id).all())
-                tmp = []
-                for answer in answers:
-                    if role in self.get_user(answer.user_id).get_roles():
-                        tmp.append(answer)
-                answers = tmp
-        elif tg_user_id:
-            answers = copy.deepcopy(session.query(Answer).filter(Answer.user_id == tg_user_id).all())
-        else:
-            raise AttributeError("Attrs were not given")
-        session.close()
-        return answers
-
-    def update_user(self, tg_id, answered_last_question=None, last_question_notifications=None, bx_id=None):
-        session = self.session()
-        user = session.query(User).filter(User.tg_user_id == tg_id).one()
-        if not answered_last_question is None:
-            user.answered_last_question = answered_last_question
-        if not last_question_notifications is None:
-            user.last_question_notifications = last_question_notifications
-        if not bx_id == None:
-            user.bx_id = bx_id
-        session.commit()
-
-    def update_question(self, id_, sent_to=None, sent=None):
-        session = self.session()
-        question = session.query(Question).filter(Question.id == id_).one()
-        if not sent_to is None:
-            question.sent_to_json = json.dumps(sent_to)
-        if not sent is None:
-            question.sent = sent
+                raise AttributeError("Attrs were not given")
+            options = self._options(session, {row[2] for row in rows})
+            return [AnswerRecord(id_, user_id, question_id_, _answer_text(options[question_id_], option_id, text_),
+                                 option_id)
+                    for id_, user_id, question_id_, option_id, text_ in rows]
+
+    def _options(self, session, question_ids):
+        """{id опроса: варианты ответа}"""
+        return {id_: tuple(json.loads(options_json)) for id_, options_json in
+                session.query(Question.id, Question.answer_options_json).filter(Question.id.in_(question_ids))}
+
+    def _answers_query(self, session, columns, question_id, role=None):
+        query = session.query(*columns).filter(Answer.question_id == question_id)
+        if role:
+            query = query.join(UserRole, UserRole.tg_user_id == Answer.user_id).filter(UserRole.role_name == role)
+        return query
+
+    def get_answers_with_users(self, question_id, role=None, after=None, limit=None):
+        """[(id ответа, user_str, текст ответа)] в порядке поступления, при постраничной выборке -
+        limit ответов с id больше after"""
+        with self.session_scope() as session:
+            query = self._answers_query(session, (Answer.id, User.user_str, Answer.option_id, Answer.text),
+                                        question_id, role). \
+                join(User, User.tg_user_id == Answer.user_id).order_by(Answer.id)
+            if after is not None:
+                query = query.filter(Answer.id > after)
+            options = self._options(session, [question_id]).get(question_id, ())
+            return [(id_, user_str, _answer_text(options, option_id, text_))
+                    for id_, user_str, option_id, text_ in query.limit(limit)]
+
+    def iter_answers_export(self, question_id=None, chunk=10000):
+        """Пачки по chunk строк (id ответа, id опроса, текст опроса, tg_user_id, user_str, роли, ответ) для выгрузки
+        всех ответов или ответов на один опрос. Строки читаются курсором по мере выдачи пачек, в памяти
+        только одна пачка и тексты опросов. Курсор DBAPI используется напрямую: разбор строк в Row
+        SQLAlchemy почти удваивает время выгрузки"""
+        roles = select(UserRole.tg_user_id, func.group_concat(UserRole.role_name, ", ").label("roles")). \
+            group_by(UserRole.tg_user_id).subquery()
+        statement = select(Answer.id, Answer.question_id, Answer.user_id, User.user_str, roles.c.roles,
+                           Answer.option_id, Answer.text). \
+            outerjoin(User, User.tg_user_id == Answer.user_id). \
+            outerjoin(roles, roles.c.tg_user_id == Answer.user_id).order_by(Answer.id)
+        if question_id is not None:
+            statement = statement.where(Answer.question_id == question_id)
+        with self.session_scope() as session:
+            questions = session.query(Question.id, Question.text, Question.answer_options_json)
+            if question_id is not None:
+                questions = questions.filter(Question.id == question_id)
+            questions = {id_: (text_, json.loads(options_json)) for id_, text_, options_json in questions}
+            cursor = session.connection().connection.cursor()
+            cursor.execute(str(statement.compile(self.engine, compile_kwargs={"literal_binds": True})))
+            while rows := cursor.fetchmany(chunk):
+                batch = []
+                for id_, question_id_, user_id, user_str, user_roles, option_id, text_ in rows:
+                    question_text, options = questions.get(question_id_, ("", []))
+                    batch.append((id_, question_id_, question_text, user_id, user_str, user_roles or "",
+                                  _answer_text(options, option_id, text_)))
+                yield batch
+
+    def get_user_answers(self, tg_user_id, after=None, limit=None):
+        """[(id ответа, текст опроса, текст ответа)] пользователя, при постраничной выборке -
+        limit ответов с id больше after"""
+        with self.session_scope() as session:
+            query = session.query(Answer.id, Question.text, Question.answer_options_json, Answer.option_id,
+                                  Answer.text). \
+                join(Question, Question.id == Answer.question_id). \
+                filter(Answer.user_id == tg_user_id).order_by(Answer.id)
+            if after is not None:
+                query = query.filter(Answer.id > after)
+            return [(id_, question_text, json.loads(options_json)[option_id] if option_id is not None else text_)
+                    for id_, question_text, options_json, option_id, text_ in query.limit(limit)]
+
+    def update_user(self, tg_id, bx_id=None):
+        with self.session_scope() as session:
+            user = session.query(User).filter(User.tg_user_id == tg_id).one()
+            if not bx_id == None:
+                user.bx_id = bx_id
+
+    def get_recipients(self, question_id):
+        """Адресаты опроса, которым он еще не доставлен: [tg_user_id]"""
+        with self.session_scope() as session:
+            question = session.query(Question).filter(Question.id == question_id).one()
+            query = session.query(User.tg_user_id)
+            if not question.for_all:
+                by_user = session.query(QuestionUser.tg_user_id).filter(QuestionUser.question_id == question_id)
+                by_role = session.query(UserRole.tg_user_id). \
+                    join(QuestionRole, QuestionRole.role_name == UserRole.role_name). \
+                    filter(QuestionRole.question_id == question_id)
+                query = query.filter(or_(User.tg_user_id.in_(by_user), User.tg_user_id.in_(by_role)))
+            query = query.filter(~exists().where(Delivery.question_id == question_id).
+                                 where(Delivery.tg_user_id == User.tg_user_id))
+            return [tg_user_id for tg_user_id, in query]
+
+    def mark_sent(self, question_id, tg_user_ids):
+        """Отмечает пачку получателей опроса перед отправкой - одна транзакция с одним INSERT на всю пачку.
+        Опрос ждет ответа только после save_deliveries, когда сообщение отправлено.
+
+        Возвращает тех, кого еще не отмечали: остальных уже отметил другой процесс.
+        Пустое обновление опроса идет первым и сразу берет блокировку записи, поэтому проверка доставок ниже
+        не может устареть до конца транзакции."""
+        with self.session_scope() as session:
+            session.query(Question).filter(Question.id == question_id). \
+                update({Question.sent: Question.sent}, synchronize_session=False)
+            already = {tg_user_id for tg_user_id, in session.query(Delivery.tg_user_id).
+                       filter(Delivery.question_id == question_id).filter(Delivery.tg_user_id.in_(tg_user_ids))}
+            claimed = [tg_user_id for tg_user_id in tg_user_ids if tg_user_id not in already]
+            if claimed:
+                session.execute(sqlite_insert(Delivery),
+                                [{"question_id": question_id, "tg_user_id": tg_user_id, "answered": False}
+                                 for tg_user_id in claimed])
+            return claimed
+
+    def get_next_reminder_due(self):
+        with self.session_scope() as session:
+            return session.query(func.min(Reminder.due)).scalar()
+
+    def process_due_reminders(self, now, interval, max_notifications, limit=500):
+        """Переносит наступившие напоминания на interval вперед.
+
+        После max_notifications напоминаний об опросе больше не напоминает, но он остается в очереди ожидающих ответа.
+        Напоминания об опросах, на которые уже ответили, удаляются: пачка доставок может сохранить напоминание
+        уже после ответа. Возвращает ([tg_user_id, кому напомнить], сколько напоминаний обработано)."""
+        with self.session_scope() as session:
+            reminders = session.query(Reminder, Delivery.answered). \
+                outerjoin(Delivery, and_(Delivery.tg_user_id == Reminder.tg_user_id,
+                                         Delivery.question_id == Reminder.question_id)). \
+                filter(Reminder.due <= now).order_by(Reminder.due).limit(limit).all()
+            to_notify = {}
+            for reminder, answered in reminders:
+                if not answered and reminder.notifications < max_notifications:
+                    reminder.notifications += 1
+                    reminder.due = now + interval
+                    to_notify[reminder.tg_user_id] = None
+                else:
+                    session.delete(reminder)
+        return list(to_notify), len(reminders)
+
+    def save_leads(self, leads):
+        if not leads:
+            return
+        rows = [{"id": int(lead["ID"]), "created_by_id": int(lead["CREATED_BY_ID"]),
+                 "date_create": _bx_datetime(lead["DATE_CREATE"]), "date_modify": _bx_datetime(lead["DATE_MODIFY"]),
+                 "status_id": lead["STATUS_ID"], "date_closed": _bx_datetime(lead["DATE_CLOSED"])} for lead in leads]
+        statement = sqlite_insert(Lead)
+        statement = statement.on_conflict_do_update(
+            index_elements=[Lead.id],
+            set_={column: statement.excluded[column] for column in rows[0] if column != "id"})
+        with self.session_scope() as session:
+            session.execute(statement, rows)
+            self._rebuild_lead_daily(session, {(row["created_by_id"], row["date_create"].date()) for row in rows})
+
+    def _rebuild_lead_daily(self, session, keys):
+        for bx_id, days in _group(keys).items():
+            session.query(LeadDaily).filter(LeadDaily.bx_id == bx_id).filter(LeadDaily.day.in_(days)). \
+                delete(synchronize_session=False)
+            day = func.date(Lead.date_create)
+            rows = session.query(day, func.count(Lead.id),
+                                 func.sum(case((Lead.status_id == "CONVERTED", 1), else_=0)),
+                                 func.sum(case((Lead.date_closed == None, 1), else_=0))). \
+                filter(Lead.created_by_id == bx_id). \
+                filter(Lead.date_create >= datetime.datetime.combine(min(days), datetime.time())). \
+                filter(Lead.date_create < datetime.datetime.combine(max(days), datetime.time()) +
+                       datetime.timedelta(days=1)). \
+                group_by(day).all()
+            session.add_all([LeadDaily(bx_id=bx_id, day=datetime.date.fromisoformat(day_), leads=leads,
+                                       converted=converted, in_work=in_work)
+                             for day_, leads, converted, in_work in rows
+                             if datetime.date.fromisoformat(day_) in days])
+
+    def get_lead_syncs(self, bx_ids):
+        with self.session_scope() as session:
+            return {sync.bx_id: sync for sync in session.query(LeadSync).filter(LeadSync.bx_id.in_(bx_ids))}
+
+    def update_lead_syncs(self, bx_ids, synced_at, covered_since=None):
+        with self.session_scope() as session:
+            for bx_id in bx_ids:
+                sync = session.get(LeadSync, bx_id) or LeadSync(bx_id=bx_id)
+                if covered_since and (not sync.covered_since or covered_since < sync.covered_since):
+                    sync.covered_since = covered_since
+                sync.synced_at = synced_at
+                session.add(sync)
+
+    def count_leads(self, bx_ids, since):
+        """(лидов, сконвертировано, не закрыто) среди лидов bx_ids, созданных начиная с дня since"""
+        with self.session_scope() as session:
+            leads, converted, in_work = session.query(
+                func.coalesce(func.sum(LeadDaily.leads), 0),
+                func.coalesce(func.sum(LeadDaily.converted), 0),
+                func.coalesce(func.sum(LeadDaily.in_work), 0)). \
+                filter(LeadDaily.bx_id.in_(bx_ids)).filter(LeadDaily.day >= since.date()).one()
+        return leads, converted, in_work
+
+    def get_bx_ids(self):
+        with self.session_scope() as session:
+            return [bx_id for bx_id, in session.query(User.bx_id).filter(User.bx_id != None).distinct()]
+
+    def save_callback(self, chat_id, message_id, func_name, args_json, created):
+        with self.session_scope() as session:
+            session.merge(PendingCallback(chat_id=chat_id, message_id=message_id, func_name=func_name,
+                                          args_json=args_json, created=created))
+
+    def delete_callback(self, chat_id, message_id):
+        with self.session_scope() as session:
+            session.query(PendingCallback).filter(PendingCallback.chat_id == chat_id). \
+                filter(PendingCallback.message_id == message_id).delete()
+
+    def delete_callbacks_before(self, created):
+        with self.session_scope() as session:
+            session.query(PendingCallback).filter(PendingCallback.created < created).delete()
+
+    def get_callbacks(self, workers=1, index=0):
+        """Колбэки чатов с chat_id % workers == index (по модулю, как в Python: у групп chat_id отрицательный)"""
+        with self.session_scope() as session:
+            return session.query(PendingCallback.chat_id, PendingCallback.message_id, PendingCallback.func_name,
+                                 PendingCallback.args_json, PendingCallback.created). \
+                filter((PendingCallback.chat_id % workers + workers) % workers == index). \
+                order_by(PendingCallback.created).all()
+
+    def pop_state(self, chat_id):
+        """Забирает состояние чата: (state, data_json) или None. Пустое обновление сразу берет блокировку записи,
+        поэтому одно состояние не достанется двум потокам или процессам"""
+        with self.session_scope() as session:
+            session.query(ConversationState).filter(ConversationState.chat_id == chat_id). \
+                update({ConversationState.state: ConversationState.state}, synchronize_session=False)
+            row = session.query(ConversationState.state, ConversationState.data_json). \
+                filter(ConversationState.chat_id == chat_id).first()
+            if row:
+                session.query(ConversationState).filter(ConversationState.chat_id == chat_id).delete()
+            return row
+
+    def set_state(self, chat_id, state, data_json):
+        with self.session_scope() as session:
+            session.merge(ConversationState(chat_id=chat_id, state=state, data_json=data_json,
+                                            updated=datetime.datetime.now()))
+
+    def acquire_lease(self, name, owner, ttl):
+        """Захватывает или продлевает аренду name на ttl секунд. True, если аренда принадлежит owner"""
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=ttl)
+        with self.session_scope() as session:
+            session.execute(sqlite_insert(Lease).values(name=name, owner=owner, expires=expires).on_conflict_do_update(
+                index_elements=[Lease.name], set_={"owner": owner, "expires": expires},
+                where=or_(Lease.owner == owner, Lease.expires < now)))
+            return session.query(Lease.owner).filter(Lease.name == name).scalar() == owner
+
+    def release_lease(self, name, owner):
+        with self.session_scope() as session:
+            session.query(Lease).filter(Lease.name == name, Lease.owner == owner).delete()
+
+    def update_question(self, id_, sent=None, text=None, answer_options=None, optional=None):
+        """Изменение текста, вариантов ответа или обязательности увеличивает версию опроса.
 
-        session.commit()
+        Ответы хранят номер варианта, поэтому, когда на опрос уже отвечали, варианты можно только дописывать в конец:
+        иначе ValueError"""
+        with self.session_scope() as session:
+            question = session.query(Question).filter(Question.id == id_).one()
+            if not sent is None:
+                question.sent = sent
+            if not text is None:
+                question.text = text
+            if not answer_options is None:
+                current = question.get_answer_options()
+                if answer_options[:len(current)] != current and \
+                        session.query(exists().where(Answer.question_id == id_)).scalar():
+                    raise ValueError(f"Question {id_} has answers, its options can only be appended")
+                question.answer_options_json = json.dumps(answer_options)
+            if not optional is None:
+                question.optional = optional
+            if not (text is None and answer_options is None and optional is None):
+                question.version += 1
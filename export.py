@@ -0,0 +1,87 @@
+import argparse
+import csv
+import gzip
+import shutil
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from database import database_handler
+
+COLUMNS = ("answer_id", "question_id", "question", "tg_user_id", "user", "roles", "answer")
+FORMATS = ("csv", "parquet")
+# Сколько строк читается из БД и записывается в файл за раз
+CHUNK_SIZE = 10000
+# Больше бот не может отправить файлом
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+
+def export_filename(question_id, fmt):
+    return f"answers_{'all' if question_id is None else question_id}.{fmt}"
+
+
+def write_csv(chunks, path):
+    rows = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        # BOM, иначе Excel не узнает кодировку и портит кириллицу; кодировка utf-8-sig делает то же, но медленнее
+        file.write("\ufeff")
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            rows += len(chunk)
+    return rows
+
+
+def write_parquet(chunks, path):
+    if pyarrow is None:
+        raise ImportError("Для выгрузки в Parquet установите пакет pyarrow")
+    schema = pyarrow.schema([("answer_id", pyarrow.int64()), ("question_id", pyarrow.int64()),
+                             ("question", pyarrow.string()), ("tg_user_id", pyarrow.int64()),
+                             ("user", pyarrow.string()), ("roles", pyarrow.string()), ("answer", pyarrow.string())])
+    rows = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            # Каждая пачка - отдельная группа строк файла
+            columns = [pyarrow.array(column, type=field.type) for column, field in zip(zip(*chunk), schema)]
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+            rows += len(chunk)
+    return rows
+
+
+def export_answers(db, path, question_id=None, fmt="csv", chunk=CHUNK_SIZE):
+    """Записывает ответы на опрос question_id (None - на все опросы) в файл path, возвращает число ответов.
+
+    Ответы читаются и пишутся пачками по chunk, поэтому память не зависит от числа ответов."""
+    write = {"csv": write_csv, "parquet": write_parquet}[fmt]
+    return write(db.iter_answers_export(question_id, chunk), path)
+
+
+def compress(path):
+    """Сжимает файл в path.gz потоком, не читая его в память целиком; возвращает путь сжатого файла"""
+    with open(path, "rb") as source, gzip.open(path + ".gz", "wb", compresslevel=6) as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    return path + ".gz"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка ответов на опросы в CSV или Parquet")
+    parser.add_argument("question", help="id опроса или all")
+    parser.add_argument("-o", "--output", help="файл выгрузки, по умолчанию answers_<опрос>.<формат>")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="csv")
+    parser.add_argument("--db", default="database/db.db", help="путь к БД бота")
+    args = parser.parse_args()
+
+    question_id = None if args.question == "all" else int(args.question)
+    output = args.output or export_filename(question_id, args.format)
+    started = time.monotonic()
+    rows = export_answers(database_handler.Handler(args.db), output, question_id, args.format)
+    print(f"Exported {rows} answers to {output} in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+from telebot.asyncio_helper import ApiTelegramException
+
+
+class LiveResults:
+    """Сообщения с результатами опросов, которые бот редактирует по мере поступления ответов.
+
+    Каждое сообщение перерисовывается не чаще раза в interval секунд и редактируется, только если текст изменился;
+    через ttl секунд сообщение перестает обновляться. render(question_id, role) - корутина, возвращающая текст,
+    edit(chat_id, message_id, text) - корутина редактирования."""
+
+    def __init__(self, render, edit, interval=3, ttl=60 * 60):
+        self.render = render
+        self.edit = edit
+        self.interval = interval
+        self.ttl = ttl
+        self.messages = {}  # (chat_id, message_id) -> [question_id, role, текст, до какого времени обновлять]
+        self.wakeup = asyncio.Event()
+        self.edits = 0
+
+    def watch(self, chat_id, message_id, question_id, role, text):
+        self.messages[(chat_id, message_id)] = [question_id, role, text, time.monotonic() + self.ttl]
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            if not self.messages:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            await asyncio.sleep(self.interval)
+            await self.refresh()
+
+    async def refresh(self):
+        now = time.monotonic()
+        for key, entry in list(self.messages.items()):
+            question_id, role, shown, expires = entry
+            if now > expires:
+                del self.messages[key]
+                continue
+            try:
+                text = await self.render(question_id, role)
+                if text != shown:
+                    await self.edit(*key, text)
+                    entry[2] = text
+                    self.edits += 1
+            except ApiTelegramException as e:
+                if "message is not modified" not in e.description:
+                    print(f"Live results {key} stopped: {e.description}")
+                    del self.messages[key]
+            except Exception as e:
+                print(f"Live results {key} stopped: {e}")
+                del self.messages[key]
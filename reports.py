@@ -0,0 +1,48 @@
+MAX_MESSAGE_LENGTH = 4096
+
+
+def truncate(text, limit=MAX_MESSAGE_LENGTH):
+    """text, обрезанный до limit символов (последний из них - "…")"""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+class Report:
+    """Отчет, который выдается страницами не длиннее одного сообщения Telegram.
+
+    fetch(after, limit, *params) - до limit строк отчета, следующих за ключом after (None - с начала),
+    key(row) - json-совместимый ключ строки, после которого начнется следующая страница,
+    render(row, prev) - текст строки (prev - предыдущая строка на этой странице или None),
+    header(*params) - текст в начале каждой страницы, обрезается до половины страницы, чтобы оставалось место для строк.
+    Строки выбираются порциями по chunk, так что в памяти не больше одной страницы отчета."""
+
+    def __init__(self, fetch, key, render, header=None, empty="Нет данных", chunk=100, limit=MAX_MESSAGE_LENGTH):
+        self.fetch = fetch
+        self.key = key
+        self.render = render
+        self.header = header
+        self.empty = empty
+        self.chunk = chunk
+        self.limit = limit
+
+    def page(self, params, after=None):
+        """(текст страницы, ключ ее последней строки, есть ли следующая страница)"""
+        text = self.header(*params) if self.header else ""
+        if len(text) > self.limit // 2:
+            text = truncate(text, self.limit // 2 - 1) + "\n"
+        prev = None
+        last_key = after
+        while True:
+            rows = self.fetch(last_key, self.chunk, *params)
+            for row in rows:
+                line = self.render(row, prev)
+                if len(text) + len(line) + 1 > self.limit:
+                    if prev is not None:
+                        return text, last_key, True
+                    # Строка не помещается даже на пустую страницу
+                    line = line[:self.limit - len(text) - 2] + "…"
+                text += line + "\n"
+                prev, last_key = row, self.key(row)
+            if len(rows) < self.chunk:
+                if prev is None and after is None:
+                    text += self.empty
+                return text, last_key, False
@@ -0,0 +1,105 @@
+import json
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryStateStorage:
+    def __init__(self):
+        self.states = {}
+
+    def pop(self, chat_id):
+        return self.states.pop(chat_id, None)
+
+    def set(self, chat_id, state, data):
+        self.states[chat_id] = (state, json.loads(json.dumps(data)))
+
+
+class SqliteStateStorage:
+    """Состояния в таблице conversation_states общей БД, доступны всем процессам бота"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def pop(self, chat_id):
+        row = self.db.pop_state(chat_id)
+        return (row[0], json.loads(row[1])) if row else None
+
+    def set(self, chat_id, state, data):
+        self.db.set_state(chat_id, state, json.dumps(data))
+
+
+class RedisStateStorage:
+    def __init__(self, url, prefix="question_bot:state:", ttl=24 * 60 * 60):
+        if redis is None:
+            raise ImportError("Для хранения состояний в Redis установите пакет redis")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def pop(self, chat_id):
+        # GET и DELETE в одной транзакции MULTI: состояние достанется только одному из процессов
+        pipe = self.client.pipeline()
+        pipe.get(f"{self.prefix}{chat_id}")
+        pipe.delete(f"{self.prefix}{chat_id}")
+        value, _ = pipe.execute()
+        if value is None:
+            return None
+        state, data = json.loads(value)
+        return state, data
+
+    def set(self, chat_id, state, data):
+        self.client.set(f"{self.prefix}{chat_id}", json.dumps([state, data]), ex=self.ttl)
+
+
+async def _call(func, *args):
+    return func(*args)
+
+
+def make_state_storage(kind, db=None, redis_url=None):
+    if kind == "memory":
+        return MemoryStateStorage()
+    if kind == "sqlite":
+        return SqliteStateStorage(db)
+    if kind == "redis":
+        return RedisStateStorage(redis_url)
+    raise ValueError(f"Unknown state storage: {kind}")
+
+
+class StateMachine:
+    """Многошаговые диалоги: состояние чата - имя шага и его аргументы (json-совместимые).
+
+    Шаги регистрируются декоратором @step и вызываются как step(message, *args). Хранилище вызывается через
+    run(func, *args) - корутину, которая может, например, вынести запрос к БД в пул потоков."""
+
+    def __init__(self, storage, run=None):
+        self.storage = storage
+        self.run = run or _call
+        self.steps = {}
+
+    def step(self, func):
+        self.steps[func.__name__] = func
+        return func
+
+    async def set(self, chat_id, func, *args):
+        if func.__name__ not in self.steps:
+            raise ValueError(f"{func.__name__} is not registered as a step")
+        await self.run(self.storage.set, chat_id, func.__name__, list(args))
+
+    async def claim(self, message):
+        """Фильтр обработчика шагов: забирает состояние чата и сохраняет его в message.step_state для dispatch.
+        Состояние читается и удаляется одним вызовом хранилища, и следующее сообщение чата его уже не застанет"""
+        state = await self.run(self.storage.pop, message.chat.id)
+        if state is None:
+            return False
+        message.step_state = state
+        return True
+
+    async def dispatch(self, message):
+        if not hasattr(message, "step_state") and not await self.claim(message):
+            return
+        name, args = message.step_state
+        if name in self.steps:
+            await self.steps[name](message, *args)
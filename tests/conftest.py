@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import database_handler  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    return database_handler.Handler(str(tmp_path / "db.db"))
@@ -0,0 +1,37 @@
+import datetime
+import sqlite3
+import time
+
+from database import database_handler
+
+ANSWERS = 50000
+ROLE_MEMBERS = 10000
+# Замер на 50k ответов и 10k участников роли - около 65 мс, граница с запасом на медленные машины
+FETCH_BOUND = 0.5
+
+
+def seed_answers(db):
+    """Один опрос, ANSWERS пользователей с ответами, каждый пятый в роли staff"""
+    db.create_question(database_handler.Question(text="Q", for_all=True, answer_options=["Да", "Нет"],
+                                                 optional=False, send_datetime=datetime.datetime.now()))
+    db.create_role("staff")
+    # Через ORM засев занял бы минуту, поэтому строки вставляются напрямую
+    conn = sqlite3.connect(db.database_path)
+    with conn:
+        conn.executemany("INSERT INTO users (tg_user_id, username, user_str, admin) VALUES (?, ?, ?, 0)",
+                         [(tg_user_id, f"u{tg_user_id}", f"User{tg_user_id}") for tg_user_id in range(1, ANSWERS + 1)])
+        conn.executemany("INSERT INTO user_roles (tg_user_id, role_name) VALUES (?, 'staff')",
+                         [(tg_user_id,) for tg_user_id in range(5, ANSWERS + 1, ANSWERS // ROLE_MEMBERS)])
+        conn.executemany("INSERT INTO answers (user_id, question_id, option_id) VALUES (?, 1, ?)",
+                         [(tg_user_id, tg_user_id % 2) for tg_user_id in range(1, ANSWERS + 1)])
+    conn.close()
+
+
+def test_role_filtered_answers_fetch(db):
+    seed_answers(db)
+    started = time.monotonic()
+    answers = db.get_answers(question_id=1, role="staff")
+    elapsed = time.monotonic() - started
+    assert len(answers) == ROLE_MEMBERS
+    assert all(answer.user_id % 5 == 0 for answer in answers)
+    assert elapsed < FETCH_BOUND, f"{elapsed * 1000:.0f} ms"
@@ -0,0 +1,105 @@
+import asyncio
+import datetime
+import time
+
+import pytest
+
+from benchmarks import bitrix_load
+from bitrix_leads import LeadCache, LeadFetcher, format_bx_datetime
+from database.database_handler import Lead
+
+
+def user_filters(users, days=10):
+    since = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=days), datetime.time())
+    return [{">=DATE_CREATE": format_bx_datetime(since), "CREATED_BY_ID": str(bx_id)}
+            for bx_id in range(1, users + 1)]
+
+
+def expected_ids(leads, filters):
+    return {lead["ID"] for lead in leads if any(bitrix_load._matches(lead, conditions) for conditions in filters)}
+
+
+def test_pages_are_fetched_in_batches():
+    # 60 пользователей по 120 лидов за 10 дней: первые страницы - 2 batch, оставшиеся 2 * 60 страниц - еще 3
+    leads = bitrix_load.make_leads(60, 120, days=10)
+    filters = user_filters(60)
+    fetched, stats = asyncio.run(bitrix_load.run(leads, filters, rate=100, concurrency=2))
+    assert {lead["ID"] for lead in fetched} == expected_ids(leads, filters) and len(fetched) == 60 * 120
+    assert stats["requests"] == 5 and stats["rejected"] == 0
+    assert stats["commands"] == 60 * 3 and stats["max_commands"] == 50
+
+
+def test_query_limit_exceeded_is_retried():
+    leads = bitrix_load.make_leads(60, 120, days=10)
+    filters = user_filters(60)
+    fetched, stats = asyncio.run(bitrix_load.run(leads, filters, rate=100, concurrency=2, reject_first=3,
+                                                 retry_delay=0.01))
+    assert len(fetched) == 60 * 120
+    assert stats["rejected"] == 3 and stats["requests"] == 5 + 3
+
+
+def test_requests_over_portal_limit_are_retried():
+    # Портал пропускает 2 запроса в секунду, fetcher отправляет чаще и получает отказы, но загружает все
+    leads = bitrix_load.make_leads(60, 120, days=10)
+    fetched, stats = asyncio.run(bitrix_load.run(leads, user_filters(60), rate=100, concurrency=2, portal_rate=2,
+                                                 retry_delay=0.1))
+    assert len(fetched) == 60 * 120
+    assert stats["rejected"] > 0 and stats["requests"] == 5 + stats["rejected"]
+
+
+def test_modified_filter_returns_only_changed_leads():
+    leads = bitrix_load.make_leads(2, 10, days=10)
+    changed = format_bx_datetime(datetime.datetime.now() - datetime.timedelta(hours=1))
+    for lead in leads[:3]:
+        lead["DATE_MODIFY"] = bitrix_load.portal_datetime(datetime.datetime.now())
+    filters = [{">DATE_MODIFY": changed, "CREATED_BY_ID": "1"}]
+    fetched, _ = asyncio.run(bitrix_load.run(leads, filters, rate=100, concurrency=2))
+    assert sorted(lead["ID"] for lead in fetched) == ["1", "2", "3"]
+
+
+def test_lead_cache_loads_and_counts_leads(db):
+    async def main():
+        runner, url = await bitrix_load.serve(bitrix_load.MockBitrix(bitrix_load.make_leads(2, 10, days=10)))
+        fetcher = LeadFetcher(url, rate=100)
+        try:
+            since = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=20), datetime.time())
+            return await LeadCache(db, fetcher, datetime.timedelta(minutes=5)).stats([1, 2], since)
+        finally:
+            await fetcher.close()
+            await runner.cleanup()
+
+    # Каждый четвертый лид сконвертирован, закрытых нет
+    assert asyncio.run(main()) == (20, 6, 20)
+
+
+@pytest.fixture
+def server_ahead_of_portal(monkeypatch):
+    # Сервер в UTC+5, портал в UTC+3
+    monkeypatch.setenv("TZ", "Etc/GMT-5")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_modified_leads_are_synced_across_time_zones(db, server_ahead_of_portal):
+    now = datetime.datetime.now().replace(microsecond=0)
+    since = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=20), datetime.time())
+    leads = bitrix_load.make_leads(1, 3, days=10)
+    db.update_lead_syncs([1], now - datetime.timedelta(hours=2), covered_since=since)
+    leads[0]["DATE_MODIFY"] = bitrix_load.portal_datetime(now - datetime.timedelta(hours=1))
+
+    async def main():
+        runner, url = await bitrix_load.serve(bitrix_load.MockBitrix(leads))
+        fetcher = LeadFetcher(url, rate=100)
+        try:
+            await LeadCache(db, fetcher, datetime.timedelta(minutes=30)).refresh([1], since)
+        finally:
+            await fetcher.close()
+            await runner.cleanup()
+
+    asyncio.run(main())
+    # Без смещения в фильтре портал счел бы время синхронизации своим, на 2 часа позже, и пропустил бы лид
+    with db.session_scope() as session:
+        assert [(lead.id, lead.date_modify) for lead in session.query(Lead)] == \
+               [(1, now - datetime.timedelta(hours=1))]
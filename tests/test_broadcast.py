@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from telebot.asyncio_helper import ApiTelegramException
+
+from broadcast import Broadcaster, RateLimiter
+
+
+def telegram_error(code, retry_after=None):
+    result_json = {"ok": False, "error_code": code, "description": f"Error {code}"}
+    if retry_after is not None:
+        result_json["parameters"] = {"retry_after": retry_after}
+    return ApiTelegramException("sendMessage", None, result_json)
+
+
+def test_broadcast_sends_only_claimed_and_retries_after_flood_limit(capsys):
+    attempts = {}
+    claimed = []
+
+    async def send(chat_id):
+        attempts.setdefault(chat_id, []).append(time.monotonic())
+        if chat_id == 5 and len(attempts[chat_id]) == 1:
+            raise telegram_error(429, retry_after=0.3)
+        if chat_id == 7:
+            raise telegram_error(403)
+
+    def claim(chat_ids):
+        # Каждого третьего уже отметил другой процесс
+        chunk = [chat_id for chat_id in chat_ids if chat_id % 3]
+        claimed.extend(chunk)
+        return chunk
+
+    broadcaster = Broadcaster(RateLimiter(global_rate=1000, chat_rate=1000), workers=4, claim_chunk=5)
+    stats = asyncio.run(broadcaster.run(range(1, 21), send, claim))
+
+    assert set(attempts) == set(claimed) == {chat_id for chat_id in range(1, 21) if chat_id % 3}
+    assert all(len(times) == 1 for chat_id, times in attempts.items() if chat_id != 5)
+    first, retry = attempts[5]
+    assert retry - first >= 0.3
+    assert (stats["sent"], stats["failed"], stats["skipped"]) == (len(claimed) - 1, 1, 6)
+    assert stats["rate"] == stats["sent"] / stats["elapsed"]
+    assert "msg/s" in capsys.readouterr().out
+
+
+def test_rate_limiter_applies_global_and_per_chat_buckets():
+    async def acquire_all(limiter, chat_ids):
+        started = time.monotonic()
+        for chat_id in chat_ids:
+            await limiter.acquire(chat_id)
+        return time.monotonic() - started
+
+    # 20 разных чатов при глобальном лимите 10 в секунду: 10 сразу, еще 10 - за секунду
+    assert asyncio.run(acquire_all(RateLimiter(global_rate=10, chat_rate=100), range(20))) >= 0.9
+    # 6 сообщений в один чат при лимите 4 в секунду на чат: 4 сразу, еще 2 - за полсекунды
+    assert asyncio.run(acquire_all(RateLimiter(global_rate=1000, chat_rate=4), [1] * 6)) >= 0.45
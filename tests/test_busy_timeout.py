@@ -0,0 +1,22 @@
+import threading
+
+from sqlalchemy import text
+
+import bot_config as cfg
+
+
+def busy_timeout(db):
+    with db.session_scope() as session:
+        return session.execute(text("PRAGMA busy_timeout")).scalar()
+
+
+def test_thread_busy_timeout_applies_only_to_its_thread(db):
+    db.set_thread_busy_timeout(0.5)
+    assert busy_timeout(db) == 500
+    other = []
+    thread = threading.Thread(target=lambda: other.append(busy_timeout(db)))
+    thread.start()
+    thread.join()
+    # Поток берет то же соединение из пула, но со своим таймаутом
+    assert other == [int(cfg.DB_BUSY_TIMEOUT * 1000)]
+    assert busy_timeout(db) == 500
@@ -0,0 +1,12 @@
+import datetime
+
+
+def test_callbacks_are_loaded_by_worker_partition(db):
+    created = datetime.datetime.now()
+    for chat_id in (4, 5, 6, -5, -6):
+        db.save_callback(chat_id, 1, "report_page", "[]", created)
+    # Диспетчер раздает чаты по chat_id % WORKERS в Python, у групп chat_id отрицательный
+    for index in range(3):
+        assert sorted(row.chat_id for row in db.get_callbacks(3, index)) == \
+               sorted(chat_id for chat_id in (4, 5, 6, -5, -6) if chat_id % 3 == index)
+    assert len(db.get_callbacks()) == 5
@@ -0,0 +1,20 @@
+import csv
+
+import export
+from benchmarks import export_load
+from database import database_handler
+
+
+def test_export_streams_all_answers(tmp_path):
+    path = str(tmp_path / "db.db")
+    export_load.seed(path, answers=2500, users=200)
+    output = str(tmp_path / "answers.csv")
+    rows = export.export_answers(database_handler.Handler(path), output, chunk=1000)
+    assert rows == 2500
+    with open(output, encoding="utf-8-sig", newline="") as file:
+        table = list(csv.reader(file))
+    assert table[0] == list(export.COLUMNS)
+    assert [int(row[0]) for row in table[1:]] == list(range(1, 2501))
+    # Ответ 200 - первый ответ на опрос 2 со свободным ответом, пользователь 1 в роли sales
+    assert table[201][1:] == ["2", "Опрос 2", "1", "Пользователь 1", "sales", "Свободный ответ 200, \"с кавычками\""]
+    assert table[1][6] == "Да"
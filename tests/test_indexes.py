@@ -0,0 +1,80 @@
+import datetime
+import sqlite3
+
+from sqlalchemy import event
+
+from database import database_handler
+
+
+def query_plan(db, call):
+    """Планы EXPLAIN QUERY PLAN всех SELECT, которые выполняет call()"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        call()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+    conn = sqlite3.connect(db.database_path)
+    try:
+        return "\n".join(row[3] for statement, parameters in statements
+                         for row in conn.execute("EXPLAIN QUERY PLAN " + statement, parameters))
+    finally:
+        conn.close()
+
+
+def seed(db):
+    for tg_user_id in range(1, 51):
+        db.create_user(tg_user_id, f"u{tg_user_id}", f"User{tg_user_id}")
+    for _ in range(5):
+        db.create_question(database_handler.Question(text="Q", for_all=True, answer_options=["Да", "Нет"],
+                                                     optional=False, send_datetime=datetime.datetime.now()))
+    db.save_answers([(tg_user_id, question_id, tg_user_id % 2, None)
+                     for tg_user_id in range(1, 51) for question_id in range(1, 6)])
+
+
+def test_user_lookup_by_username_uses_index(db):
+    seed(db)
+    assert "USING INDEX ix_users_username" in query_plan(db, lambda: db.get_user(username="u7"))
+
+
+def test_answers_by_question_use_index(db):
+    seed(db)
+    assert "ix_answers_question_id" in query_plan(db, lambda: db.get_answers(question_id=3))
+
+
+def test_answers_by_user_use_unique_index(db):
+    seed(db)
+    assert "ux_answers_user_id_question_id" in query_plan(db, lambda: db.get_user_answers(7))
+
+
+def test_due_questions_use_index(db):
+    seed(db)
+    assert "ix_questions_sent_send_datetime" in query_plan(db, db.get_outdated_questions)
+
+
+def test_migration_3_removes_duplicate_answers(tmp_path):
+    path = str(tmp_path / "db.db")
+    db = database_handler.Handler(path)
+    for _ in range(2):
+        db.create_question(database_handler.Question(text="Q", for_all=True, answer_options=[], optional=False,
+                                                     send_datetime=datetime.datetime.now()))
+    conn = sqlite3.connect(path)
+    conn.execute("DROP INDEX ux_answers_user_id_question_id")
+    conn.executemany("INSERT INTO answers (user_id, question_id, text) VALUES (?, ?, ?)",
+                     [(1, 1, "первый"), (1, 1, "второй"), (2, 1, "другой пользователь"), (1, 2, "другой опрос")])
+    conn.execute("PRAGMA user_version = 2")
+    conn.commit()
+    conn.close()
+
+    db = database_handler.Handler(path)
+    assert [(answer.user_id, answer.text) for answer in db.get_answers(question_id=1)] == \
+        [(1, "первый"), (2, "другой пользователь")]
+    assert not db.create_answer(1, 2, "повторный ответ")
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT COUNT(*) FROM answers WHERE user_id = 1 AND question_id = 2").fetchone()[0] == 1
+    conn.close()
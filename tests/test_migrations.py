@@ -0,0 +1,58 @@
+import json
+import sqlite3
+
+from sqlalchemy import text
+
+from database import database_handler
+
+# Схема БД первой версии бота, до версионных миграций
+BASELINE_SCHEMA = """
+CREATE TABLE roles (name VARCHAR NOT NULL PRIMARY KEY, users_json VARCHAR);
+CREATE TABLE users (tg_user_id INTEGER NOT NULL PRIMARY KEY, username VARCHAR, user_str VARCHAR, roles_json VARCHAR,
+                    admin BOOLEAN, answered_last_question BOOLEAN, last_question_notifications INTEGER,
+                    bx_id INTEGER);
+CREATE TABLE questions (id INTEGER NOT NULL PRIMARY KEY, text VARCHAR, for_all BOOLEAN, roles_for_json VARCHAR,
+                        users_for_json VARCHAR, answer_options_json VARCHAR, optional BOOLEAN,
+                        send_datetime DATETIME, sent BOOLEAN, sent_to_json VARCHAR);
+CREATE TABLE answers (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER, question_id INTEGER, text VARCHAR);
+"""
+
+
+def make_baseline(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO roles VALUES ('r', ?)", (json.dumps([1]),))
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, 0, 1, 0, NULL)",
+                     [(1, "u1", "User1", json.dumps(["r"])), (2, "u2", "User2", "[]")])
+    conn.execute("INSERT INTO questions VALUES (1, 'Q', 1, '[]', '[]', ?, 0, '2022-01-01 10:00:00.000000', 1, ?)",
+                 (json.dumps(["Да", "Нет"]), json.dumps([1])))
+    conn.executemany("INSERT INTO answers (user_id, question_id, text) VALUES (?, ?, ?)",
+                     [(1, 1, "Да"), (1, 1, "Нет")])
+    conn.commit()
+    conn.close()
+
+
+def test_baseline_database_is_migrated(tmp_path):
+    path = str(tmp_path / "db.db")
+    make_baseline(path)
+    db = database_handler.Handler(path)
+
+    with db.engine.connect() as conn:
+        assert conn.execute(text("PRAGMA user_version")).scalar() == database_handler.SCHEMA_VERSION
+    assert db.get_user(1).get_roles() == ["r"]
+    # Опрос уже доставлен первому пользователю и не должен прийти ему повторно
+    assert db.get_recipients(1) == [2]
+    assert db.get_pending(1) == []
+    # Повторный ответ удален, оставшийся хранится номером варианта и попадает в счетчики
+    answers = db.get_answers(question_id=1)
+    assert [(answer.user_id, answer.text, answer.option_id) for answer in answers] == [(1, "Да", 0)]
+    assert db.get_tallies(1) == {0: 1}
+    assert db.get_tallies(1, "r") == {0: 1}
+
+
+def test_current_database_is_not_migrated_again(tmp_path):
+    path = str(tmp_path / "db.db")
+    db = database_handler.Handler(path)
+    db.create_user(1, "u1", "User1")
+    database_handler.Handler(path)
+    assert [user.tg_user_id for user in db.get_users()] == [1]
@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+from database import database_handler
+
+
+def create_question(db, send_datetime, **kwargs):
+    question = database_handler.Question(text="Q", for_all=True, answer_options=["Да", "Нет"], optional=False,
+                                         send_datetime=send_datetime, **kwargs)
+    db.create_question(question)
+    return question.id
+
+
+def test_next_send_datetime_includes_overdue_questions(db):
+    now = datetime.datetime.now()
+    sent = create_question(db, now - datetime.timedelta(minutes=5))
+    db.update_question(sent, sent=True)
+    overdue = now - datetime.timedelta(seconds=1)
+    create_question(db, overdue)
+    create_question(db, now + datetime.timedelta(hours=1))
+    # Опрос, наступивший во время рассылки предыдущего, не должен ждать следующего пробуждения рассыльщика
+    assert db.get_next_send_datetime() == overdue
+
+
+def test_no_reminder_for_answer_saved_before_delivery_batch(db):
+    now = datetime.datetime.now()
+    question_id = create_question(db, now)
+    for tg_user_id in (1, 2):
+        db.create_user(tg_user_id, f"u{tg_user_id}", f"User{tg_user_id}")
+    db.mark_sent(question_id, [1, 2])
+    # Пользователь 1 ответил раньше, чем записалась пачка доставок с его напоминанием
+    db.save_answers([(1, question_id, 0, None)])
+    db.save_deliveries([(tg_user_id, question_id, 100 + tg_user_id, now) for tg_user_id in (1, 2)])
+    interval = datetime.timedelta(minutes=10)
+    assert db.process_due_reminders(now, interval, 3) == ([2], 2)
+    assert db.get_next_reminder_due() == now + interval
+
+
+def test_question_waits_for_answer_only_after_it_was_sent(db):
+    now = datetime.datetime.now()
+    first, second = create_question(db, now), create_question(db, now)
+    db.create_user(1, "u1", "User1")
+    db.mark_sent(first, [1])
+    db.mark_sent(second, [1])
+    db.save_deliveries([(1, first, 101, now)])
+    # Второй опрос пользователь еще не получил: ответ не должен уйти в него
+    assert [question.question_id for question in db.get_pending(1)] == [first]
+    db.save_deliveries([(1, second, 102, now)])
+    assert [question.question_id for question in db.get_pending(1)] == [first, second]
+
+
+def test_options_of_answered_question_can_only_be_appended(db):
+    question_id = create_question(db, datetime.datetime.now())
+    db.update_question(question_id, answer_options=["Нет", "Да"])
+    db.create_user(1, "u1", "User1")
+    db.save_answers([(1, question_id, 1, None)])
+    # Ответ хранит номер варианта: после перестановки он указывал бы на другой вариант
+    with pytest.raises(ValueError):
+        db.update_question(question_id, answer_options=["Да", "Нет"])
+    with pytest.raises(ValueError):
+        db.update_question(question_id, answer_options=["Нет"])
+    db.update_question(question_id, answer_options=["Нет", "Да", "Не знаю"])
+    assert [answer.text for answer in db.get_answers(question_id=question_id)] == ["Да"]
+    assert db.get_user_answers(1) == [(1, "Q", "Да")]
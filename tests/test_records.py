@@ -0,0 +1,12 @@
+from benchmarks import records
+from database.database_handler import User
+
+
+def test_records_match_orm_objects_and_are_faster(db):
+    records.seed(db, users=500, questions=50)
+    copies = records.deepcopy_all(db, User)
+    assert [(user.tg_user_id, user.username, user.user_str, user.get_roles()) for user in copies] == \
+           [(user.tg_user_id, user.username, user.user_str, user.get_roles()) for user in db.get_users()]
+    deepcopy_time = records.best_time(lambda: records.deepcopy_all(db, User), 3)
+    # На 5000 пользователей разница около 35 раз, здесь проверяется только порядок
+    assert records.best_time(db.get_users, 3) * 5 < deepcopy_time
@@ -0,0 +1,24 @@
+from reports import MAX_MESSAGE_LENGTH, Report
+
+
+def rows_report(count, header):
+    rows = [(number, f"Ответ {number}") for number in range(count)]
+    return Report(lambda after, limit: [row for row in rows if after is None or row[0] > after][:limit],
+                  lambda row: row[0], lambda row, prev: row[1], header=lambda: header)
+
+
+def test_long_header_leaves_room_for_rows():
+    report = rows_report(3, "Опрос " * 1000 + "\n\n")
+    text, last_key, has_next = report.page(())
+    assert len(text) <= MAX_MESSAGE_LENGTH
+    assert text.endswith("Ответ 0\nОтвет 1\nОтвет 2\n") and (last_key, has_next) == (2, False)
+
+
+def test_pages_with_long_header_fit_message():
+    report = rows_report(2000, "Опрос " * 682 + "\n\n")
+    after, has_next, shown = None, True, 0
+    while has_next:
+        text, after, has_next = report.page((), after)
+        assert len(text) <= MAX_MESSAGE_LENGTH
+        shown += text.count("Ответ")
+    assert shown == 2000
@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+
+from states import MemoryStateStorage, SqliteStateStorage, StateMachine
+
+
+class CountingStorage(MemoryStateStorage):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def pop(self, chat_id):
+        self.reads += 1
+        return super().pop(chat_id)
+
+
+def make_message(chat_id, text):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=text)
+
+
+def test_step_state_is_read_once_and_claimed_by_one_message():
+    storage = CountingStorage()
+    steps = StateMachine(storage)
+    handled = []
+
+    @steps.step
+    async def ask_name(message, prefix):
+        handled.append(prefix + message.text)
+
+    async def main():
+        await steps.set(1, ask_name, "name: ")
+        first, second = make_message(1, "Ann"), make_message(1, "Bob")
+        # Фильтр обработчика проверяет оба сообщения до того, как шаг успел выполниться
+        assert await steps.claim(first) and not await steps.claim(second)
+        await steps.dispatch(first)
+        assert not await steps.claim(make_message(2, "x"))
+
+    asyncio.run(main())
+    assert handled == ["name: Ann"]
+    assert storage.reads == 3
+
+
+def test_sqlite_state_is_claimed_by_one_thread(db):
+    steps = StateMachine(SqliteStateStorage(db),
+                         lambda func, *args: asyncio.get_running_loop().run_in_executor(None, func, *args))
+
+    @steps.step
+    async def ask_name(message):
+        pass
+
+    async def main():
+        await steps.set(1, ask_name)
+        # Оба сообщения проверяются фильтром одновременно в разных потоках
+        return await asyncio.gather(*[steps.claim(make_message(1, text)) for text in ("Ann", "Bob")])
+
+    assert sorted(asyncio.run(main())) == [False, True]
@@ -0,0 +1,14 @@
+from types import SimpleNamespace
+
+from validation import AnswerValidator, duplicate_options
+
+
+def test_options_differing_only_in_case_and_spaces_are_duplicates():
+    assert duplicate_options(["Да", "Нет", " да", "НЕ  знаю", "не знаю"]) == [" да", "не знаю"]
+    assert duplicate_options(["Да", "Нет"]) == []
+
+
+def test_validator_matches_normalized_answers():
+    validator = AnswerValidator(SimpleNamespace(answer_options=("Да", "Не знаю")))
+    assert validator.option_id("  не   ЗНАЮ ") == 1
+    assert validator.option_id("Может быть") is None
@@ -0,0 +1,17 @@
+import asyncio
+
+from benchmarks import webhook_load
+
+
+def test_all_updates_are_processed():
+    stats, statuses = asyncio.run(webhook_load.run(updates=300, chats=30, concurrency=10, workers=4, queue_size=100,
+                                                   handle_time=0, port=0))
+    assert statuses == {200: 300}
+    assert stats["processed"] == 300 and stats["rejected"] == 0
+
+
+def test_full_queue_is_rejected_with_503():
+    stats, statuses = asyncio.run(webhook_load.run(updates=300, chats=30, concurrency=20, workers=1, queue_size=2,
+                                                   handle_time=0.01, port=0))
+    assert statuses.get(503, 0) == stats["rejected"] > 0
+    assert stats["processed"] == statuses[200]
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+
+def normalize(text):
+    """Ответ без учета регистра и лишних пробелов"""
+    return " ".join(text.split()).casefold()
+
+
+def duplicate_options(options):
+    """Варианты, совпадающие с одним из предыдущих после нормализации: ответ на них не различить"""
+    seen = set()
+    duplicates = []
+    for option in options:
+        key = normalize(option)
+        if key in seen:
+            duplicates.append(option)
+        seen.add(key)
+    return duplicates
+
+
+class AnswerValidator:
+    """Проверка ответа на опрос: нормализованный текст варианта -> номер варианта"""
+
+    def __init__(self, question):
+        self.question = question
+        self.option_ids = {normalize(option): option_id for option_id, option in enumerate(question.answer_options)}
+        self.options = frozenset(self.option_ids)
+
+    def option_id(self, text):
+        """Номер варианта, которому соответствует ответ, или None"""
+        return self.option_ids.get(normalize(text))
+
+
+class ValidatorCache:
+    """Общие для всех пользователей валидаторы опросов по (id, версия опроса)"""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    async def get(self, question_id, version, load):
+        """load() - корутина, загружающая опрос, если валидатора для этой версии еще нет"""
+        key = (question_id, version)
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+        validator = AnswerValidator(await load())
+        key = (validator.question.id, validator.question.version)
+        self.items[key] = validator
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+        return validator
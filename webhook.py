@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from aiohttp import web
+from telebot import types
+
+
+def update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return 0
+
+
+class WebhookServer:
+    """Принимает обновления от Telegram по HTTP и раздает их обработчикам бота.
+
+    Обновления одного чата всегда попадают в одну очередь, поэтому обрабатываются по порядку.
+    Когда очередь переполнена, сервер отвечает 503 и Telegram повторяет доставку позже."""
+
+    def __init__(self, bot, path, secret=None, workers=8, queue_size=1000):
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.queues = [asyncio.Queue(queue_size) for _ in range(workers)]
+        self.processed = 0
+        self.rejected = 0
+        self.latency = 0.0
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request):
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=403)
+        if not self.put_nowait(types.Update.de_json(await request.text())):
+            return web.Response(status=503)
+        return web.Response()
+
+    def _queue(self, update):
+        return self.queues[update_chat_id(update) % len(self.queues)]
+
+    def put_nowait(self, update):
+        try:
+            self._queue(update).put_nowait((update, time.monotonic()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        return True
+
+    async def put(self, update):
+        await self._queue(update).put((update, time.monotonic()))
+
+    async def worker(self, queue):
+        while True:
+            update, received = await queue.get()
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception as e:
+                print(f"Failed to process update {update.update_id}: {e}")
+            self.processed += 1
+            self.latency += time.monotonic() - received
+            queue.task_done()
+
+    async def serve(self, host, port):
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        print(f"Webhook server is listening on {host}:{port}{self.path}")
+        try:
+            await self.run_workers()
+        finally:
+            await runner.cleanup()
+
+    async def run_workers(self):
+        await asyncio.gather(*[self.worker(queue) for queue in self.queues])
+
+    def stats(self):
+        return {"processed": self.processed, "rejected": self.rejected,
+                "queued": sum(queue.qsize() for queue in self.queues),
+                "avg_latency": self.latency / self.processed if self.processed else 0.0}
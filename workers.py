@@ -0,0 +1,100 @@
+import asyncio
+import json
+import multiprocessing
+import queue
+
+from aiohttp import web
+from telebot import asyncio_helper, types
+
+
+def update_chat_id(update):
+    """Чат обновления, еще не разобранного в types.Update"""
+    if "message" in update:
+        return update["message"]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["from"]["id"]
+    return 0
+
+
+class UpdateDispatcher:
+    """Раздает обновления от Telegram процессам-обработчикам.
+
+    Обновления одного чата всегда попадают в один процесс, поэтому обрабатываются по порядку.
+    Сам диспетчер обновления не разбирает: types.Update из них собирают процессы-обработчики.
+    target(queue, index) - функция процесса-обработчика (index - его номер: ему достаются чаты с
+    chat_id % workers == index), она должна быть доступна для импорта."""
+
+    def __init__(self, target, workers, queue_size=1000):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [context.Process(target=target, args=(q, index), daemon=True)
+                          for index, q in enumerate(self.queues)]
+        self.dispatched = 0
+        self.rejected = 0
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        print(f"Started {len(self.processes)} worker processes")
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def _queue(self, update):
+        return self.queues[update_chat_id(update) % len(self.queues)]
+
+    def put_nowait(self, update):
+        try:
+            self._queue(update).put_nowait(update)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.dispatched += 1
+        return True
+
+    async def put(self, update):
+        await asyncio.get_running_loop().run_in_executor(None, self._queue(update).put, update)
+        self.dispatched += 1
+
+    async def poll(self, token, timeout=20):
+        offset = None
+        while True:
+            try:
+                updates = await asyncio_helper.get_updates(token, offset, timeout=timeout)
+            except Exception as e:
+                print(f"Failed to get updates: {e}")
+                await asyncio.sleep(3)
+                continue
+            for update in updates:
+                await self.put(update)
+                offset = update["update_id"] + 1
+
+    async def serve(self, host, port, path, secret=None):
+        async def handle(request):
+            if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                return web.Response(status=403)
+            if not self.put_nowait(json.loads(await request.text())):
+                return web.Response(status=503)
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post(path, handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        print(f"Webhook server is listening on {host}:{port}{path}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+
+async def consume(source, server):
+    """Перекладывает обновления из очереди диспетчера в очереди server (WebhookServer) внутри процесса"""
+    loop = asyncio.get_running_loop()
+    while True:
+        update = await loop.run_in_executor(None, source.get)
+        await server.put(types.Update.de_json(update))
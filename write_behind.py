@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+
+class WriteBehind:
+    """Копит записи и сохраняет их пачками: одна транзакция на пачку вместо commit на каждую запись.
+
+    flush(items) - синхронная запись пачки в БД, выполняется в пуле потоков. put() возвращает future,
+    который завершается после сохранения записи. on_flush() вызывается после каждой сохраненной пачки."""
+
+    def __init__(self, flush, delay=0.005, max_batch=500, on_flush=None):
+        self.flush = flush
+        self.delay = delay
+        self.max_batch = max_batch
+        self.on_flush = on_flush
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.closed = False
+        self.batches = 0
+        self.items = 0
+        self.max_size = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def put(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future, time.monotonic()))
+        self.wakeup.set()
+        return future
+
+    async def run(self):
+        while not self.closed:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.delay)
+            self.wakeup.clear()
+            await self._flush()
+
+    async def _flush(self):
+        async with self.lock:
+            while self.pending:
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self.flush, [item for item, _, _ in batch])
+                except Exception as e:
+                    print(f"Write-behind flush of {len(batch)} items failed: {e}")
+                    for _, future, _ in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                now = time.monotonic()
+                self.batches += 1
+                self.items += len(batch)
+                self.max_size = max(self.max_size, len(batch))
+                for _, future, enqueued in batch:
+                    self.latency += now - enqueued
+                    self.max_latency = max(self.max_latency, now - enqueued)
+                    if not future.done():
+                        future.set_result(None)
+                if self.on_flush:
+                    self.on_flush()
+
+    async def close(self):
+        """Сохраняет все накопленные записи; вызывается при остановке бота"""
+        self.closed = True
+        self.wakeup.set()
+        await self._flush()
+        stats = self.stats()
+        print(f"Write-behind: {stats['items']} items in {stats['batches']} batches "
+              f"(avg {stats['avg_batch']:.1f}, max {stats['max_batch']}), "
+              f"latency avg {stats['avg_latency'] * 1000:.1f}ms, max {stats['max_latency'] * 1000:.1f}ms")
+
+    def stats(self):
+        return {"batches": self.batches, "items": self.items, "queued": len(self.pending),
+                "avg_batch": self.items / self.batches if self.batches else 0.0, "max_batch": self.max_size,
+                "avg_latency": self.latency / self.items if self.items else 0.0, "max_latency": self.max_latency}